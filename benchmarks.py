@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import parallel_render
+from image_editor import MatrixEditor, command_decoder, compile_command, run_compiled, with_backend
+
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_REPEAT = 3
+
+# how many L commands the L benchmark runs, as one dot is too quick to time on its own
+DOTS_PER_RUN = 1000
+
+# how many commands the end to end script benchmarks run
+SCRIPT_COMMANDS = 1000
+
+
+def _colors():
+    """
+    Alternates between two colors, so repeated runs of a command keep changing the matrix
+    :return: generator of colors
+    """
+    while True:
+        yield 'a'
+        yield 'b'
+
+
+def _draw_serpentine(editor: MatrixEditor):
+    """
+    Draws walls on every other column, alternately open at the bottom and at the top, so the rest of the
+    matrix is a single region made of as many one pixel wide spans as possible: the worst case of an F fill
+    :param editor: the matrix editor to draw on
+    :return:
+    """
+    for x in range(1, editor.width, 2):
+        if (x // 2) % 2 == 0:
+            editor.draw_line('v', (x, 0), (x, editor.height - 2), '#')
+        else:
+            editor.draw_line('v', (x, 1), (x, editor.height - 1), '#')
+
+
+def _draw_box(editor: MatrixEditor):
+    """
+    Draws a 3x3 box in the middle of the matrix, so its center is a one pixel region: the best case of an F fill
+    :param editor: the matrix editor to draw on
+    :return:
+    """
+    x, y = editor.width // 2, editor.height // 2
+    editor.draw_rect((x - 1, y - 1), (x + 1, y + 1), '#')
+
+
+def _script(width: int, height: int) -> list:
+    """
+    Builds a script of lines, rects and fills spread over the matrix
+    :param width: the matrix width
+    :param height: the matrix height
+    :return: list of split commands, as command_decoder takes them
+    """
+    commands = [['I', str(width), str(height)]]
+    for index in range(SCRIPT_COMMANDS - 1):
+        x1, x2 = sorted(((index * 7919) % width + 1, (index * 104729) % width + 1))
+        y1, y2 = sorted(((index * 6007) % height + 1, (index * 7927) % height + 1))
+        color = 'abcdef'[index % 6]
+        kind = index % 5
+        if kind == 0:
+            commands.append(['L', str(x1), str(y1), color])
+        elif kind == 1:
+            commands.append(['H', str(x1), str(x2), str(y1), color])
+        elif kind == 2:
+            commands.append(['V', str(x1), str(y1), str(y2), color])
+        elif kind == 3:
+            commands.append(['K', str(x1), str(y1), str(x2), str(y2), color])
+        else:
+            commands.append(['F', str(x1), str(y1), color])
+    return commands
+
+
+def _lines_script(width: int, height: int) -> list:
+    """
+    Builds a script of lines and rects across the whole matrix, which a tiled canvas paints without ever waiting
+    :param width: the matrix width
+    :param height: the matrix height
+    :return: list of split commands, as command_decoder takes them
+    """
+    commands = [['I', str(width), str(height)]]
+    for index in range(SCRIPT_COMMANDS - 1):
+        x = (index * 7919) % width + 1
+        y = (index * 6007) % height + 1
+        color = 'abcdef'[index % 6]
+        kind = index % 3
+        if kind == 0:
+            commands.append(['H', '1', str(width), str(y), color])
+        elif kind == 1:
+            commands.append(['V', str(x), '1', str(height), color])
+        else:
+            commands.append(['K', str(x), str(y), str(width), str(height), color])
+    return commands
+
+
+def _benchmarks(width: int, height: int, backend: str, directory: str) -> list:
+    """
+    Lists the benchmarks for a matrix size
+    :param width: the matrix width
+    :param height: the matrix height
+    :param backend: the pixel store backend of the matrices, as MatrixEditor takes it
+    :param directory: where the S benchmark saves its files
+    :return: list of (name, setup, run): setup builds an editor, untimed, and run times an operation on it
+    """
+    colors = _colors()
+    save_path = os.path.join(directory, 'matrix')
+    script = _script(width, height)
+    lines_script = [compile_command(*command) for command in _lines_script(width, height)]
+
+    def blank():
+        return MatrixEditor(width=width, height=height, backend=backend)
+
+    def serpentine():
+        editor = blank()
+        _draw_serpentine(editor)
+        return editor
+
+    def box():
+        editor = blank()
+        _draw_box(editor)
+        return editor
+
+    def run_script(_):
+        editor = None
+        for command in script:
+            result = command_decoder(editor, *command)
+            if isinstance(result, MatrixEditor):
+                editor = result
+
+    def run_lines(_):
+        run_compiled(with_backend(command, backend) for command in lines_script)
+
+    def render_lines(_):
+        # on every CPU, which is where it gains on run_lines
+        parallel_render.render_compiled(lines_script)
+
+    def color_dots(editor):
+        color = next(colors)
+        for index in range(DOTS_PER_RUN):
+            editor.color_dot(((index * 7919) % width, (index * 6007) % height), color)
+
+    return [
+        ('I', lambda: None, lambda editor: blank()),
+        ('C', blank, lambda editor: editor.clear_matrix()),
+        ('L', blank, color_dots),
+        ('V', blank, lambda editor: editor.draw_line('v', (width // 2, 0), (width // 2, height - 1), next(colors))),
+        ('H', blank, lambda editor: editor.draw_line('h', (0, height // 2), (width - 1, height // 2), next(colors))),
+        ('K', blank, lambda editor: editor.draw_rect((0, 0), (width - 1, height - 1), next(colors))),
+        ('F best', box, lambda editor: editor.color_region((width // 2, height // 2), next(colors))),
+        ('F full', blank, lambda editor: editor.color_region((0, 0), next(colors))),
+        ('F worst', serpentine, lambda editor: editor.color_region((0, 0), next(colors))),
+        ('S', blank, lambda editor: editor.save_to_file(save_path)),
+        ('script', lambda: None, run_script),
+        ('lines', lambda: None, run_lines),
+        ('lines tiled', lambda: None, render_lines),
+    ]
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat: int = DEFAULT_REPEAT, backend: str = 'bytearray',
+                   names=None, progress_stream=None) -> dict:
+    """
+    Times each editor operation on square matrices of each size, keeping the fastest of repeated runs
+    :param sizes: the widths and heights of the matrices. F worst takes minutes on 10000x10000
+    :param repeat: how many times to run each operation
+    :param backend: the pixel store backend of the matrices, as MatrixEditor takes it
+    :param names: the names of the benchmarks to run. Defaults to all of them
+    :param progress_stream: where to report each result as it comes, if anywhere
+    :return: the report, ready to be dumped as JSON
+    """
+    if repeat <= 0:
+        raise ValueError('Repeat must be a positive integer. Received: {}'.format(repeat))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for name, setup, run in _benchmarks(width=size, height=size, backend=backend, directory=directory):
+                if names is not None and name not in names:
+                    continue
+                editor = setup()
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    run(editor)
+                    timings.append(time.perf_counter() - start)
+                results.append({'name': name, 'width': size, 'height': size, 'seconds': min(timings)})
+                if progress_stream is not None:
+                    print('{:>8} {:>5}x{:<5} {:.6f}s'.format(name, size, size, min(timings)), file=progress_stream)
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'backend': backend,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare_reports(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the results of a report with those of a baseline report
+    :param report: the report to check, as run_benchmarks returns it
+    :param baseline: the report to check against
+    :param tolerance: how much slower than the baseline a result may be, e.g. 0.1 for 10%
+    :return: list of (name, width, height, baseline seconds, seconds, regressed) for the results in both reports
+    """
+    baseline_seconds = {(result['name'], result['width'], result['height']): result['seconds']
+                        for result in baseline['results']}
+    comparisons = []
+    for result in report['results']:
+        key = (result['name'], result['width'], result['height'])
+        if key in baseline_seconds:
+            comparisons.append(key + (baseline_seconds[key], result['seconds'],
+                                      result['seconds'] > baseline_seconds[key] * (1 + tolerance)))
+    return comparisons
+
+
+def main(argv: list = None) -> int:
+    """
+    Runs the benchmarks, saving their report as JSON and comparing it with a baseline report
+    :param argv: the command line arguments. Defaults to sys.argv
+    :return: the exit status, 1 if any result regressed past the baseline
+    """
+    parser = argparse.ArgumentParser(description='Times the matrix editor operations across matrix sizes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, metavar='PIXELS',
+                        help='widths and heights of the matrices to time. Defaults to %(default)s')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='how many times to run each operation, keeping the fastest. Defaults to %(default)s')
+    parser.add_argument('--backend', default='bytearray', help='the pixel store backend. Defaults to %(default)s')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='the benchmarks to run, e.g. K "F worst" script')
+    parser.add_argument('--output', help='file to save the JSON report in. Defaults to stdout')
+    parser.add_argument('--baseline', help='JSON report to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='how much slower than the baseline a result may be. Defaults to %(default)s')
+    arguments = parser.parse_args(argv)
+
+    report = run_benchmarks(sizes=arguments.sizes, repeat=arguments.repeat, backend=arguments.backend,
+                            names=arguments.only, progress_stream=sys.stderr)
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if arguments.baseline is None:
+        return 0
+    with open(arguments.baseline, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = 0
+    for name, width, height, baseline_seconds, seconds, regressed in compare_reports(report, baseline,
+                                                                                     arguments.tolerance):
+        regressions += regressed
+        print('{:>8} {:>5}x{:<5} {:.6f}s -> {:.6f}s {:+.1%}{}'.format(
+            name, width, height, baseline_seconds, seconds, seconds / baseline_seconds - 1 if baseline_seconds else 0,
+            ' REGRESSION' if regressed else ''), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from image_editor import COMMANDS, CompiledCommand
+
+
+class OptimizationReport(namedtuple('OptimizationReport', ['total', 'unreachable', 'overwritten', 'merged'])):
+    """
+    How many commands an optimization pass removed, and why:
+    unreachable commands come after an X command, overwritten ones are painted over before anything reads them,
+    merged ones were folded into the command before them
+    """
+    __slots__ = ()
+
+    @property
+    def removed(self) -> int:
+        return self.unreachable + self.overwritten + self.merged
+
+
+class _Intervals(object):
+    """
+    Sorted set of disjoint, non touching, inclusive integer intervals
+    """
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def add(self, start: int, end: int):
+        # every interval overlapping or touching [start, end] is merged into it
+        first = bisect_left(self._ends, start - 1)
+        last = bisect_right(self._starts, end + 1)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def contains(self, point: int) -> bool:
+        index = bisect_right(self._starts, point) - 1
+        return index >= 0 and self._ends[index] >= point
+
+    def gaps(self, start: int, end: int):
+        """
+        Yields the parts of [start, end] out of the set
+        :param start: where the range starts
+        :param end: where the range ends, inclusive
+        :return: generator of (start, end) inclusive gaps
+        """
+        index = max(bisect_right(self._starts, start) - 1, 0)
+        while start <= end:
+            if index >= len(self._starts) or self._starts[index] > end:
+                yield start, end
+                return
+            if self._ends[index] >= start:
+                if self._starts[index] > start:
+                    yield start, self._starts[index] - 1
+                start = self._ends[index] + 1
+            index += 1
+
+
+class _Coverage(object):
+    """
+    The pixels painted over since the matrix was last read, going backwards through a script
+    """
+    def __init__(self):
+        self.everything = False
+        self._rows = {}
+        self._columns = {}
+
+    def reset(self):
+        self.everything = False
+        self._rows = {}
+        self._columns = {}
+
+    def cover_everything(self):
+        self.reset()
+        self.everything = True
+
+    def add(self, segment: tuple):
+        if self.everything:
+            return
+        direction, fixed, start, end = segment
+        lines = self._rows if direction == 'h' else self._columns
+        lines.setdefault(fixed, _Intervals()).add(start, end)
+
+    def covers(self, segment: tuple) -> bool:
+        """
+        Checks if every pixel of segment is covered, by segments in either direction.
+        Costs at most one lookup per pixel of the segment, so never more than painting it
+        """
+        if self.everything:
+            return True
+        direction, fixed, start, end = segment
+        lines, crossing_lines = (self._rows, self._columns) if direction == 'h' else (self._columns, self._rows)
+        line = lines.get(fixed)
+        gaps = [(start, end)] if line is None else line.gaps(start, end)
+        for gap_start, gap_end in gaps:
+            for position in range(gap_start, gap_end + 1):
+                crossing_line = crossing_lines.get(position)
+                if crossing_line is None or not crossing_line.contains(fixed):
+                    return False
+        return True
+
+
+def _always_paints(command: CompiledCommand, size: tuple) -> bool:
+    """
+    Checks if a command certainly paints its footprint, i.e. it wont fail on the matrix it runs on
+    :param command: the command to check
+    :param size: (width, height) of the matrix the command runs on, None if unknown
+    :return:
+    """
+    footprint = command.footprint()
+    if footprint is None or size is None:
+        return False
+    color = command.args[-1]
+    if len(color) != 1 or ord(color) > 0x7f:
+        return False
+    width, height = size
+    for direction, fixed, start, end in footprint:
+        fixed_limit, limit = (height, width) if direction == 'h' else (width, height)
+        if not (0 <= fixed < fixed_limit and 0 <= start and end < limit):
+            return False
+    return True
+
+
+def _creates_matrix(command: CompiledCommand) -> bool:
+    return command.name == 'I' and command.args[0] > 0 and command.args[1] > 0
+
+
+def _matrix_sizes(commands: list, size: tuple = None) -> tuple:
+    """
+    Follows the matrix size through commands
+    :param commands: list of CompiledCommand
+    :param size: (width, height) of the matrix the first command runs on, None if unknown or there is no matrix
+    :return: (for each command, the size of the matrix it runs on, the size of the matrix left by the last one)
+    """
+    sizes = []
+    for command in commands:
+        sizes.append(size)
+        if _creates_matrix(command):
+            size = command.args
+        elif command.name in ('O', 'G'):
+            size = None
+    return sizes, size
+
+
+def _eliminate_overwritten(commands: list, sizes: list, history: bool) -> tuple:
+    """
+    Drops the commands whose pixels are all painted over before the next command that reads the matrix
+    :param commands: list of CompiledCommand
+    :param sizes: for each command, the size of the matrix it runs on, as _matrix_sizes returns them
+    :param history: whether the matrices keep an undo history, so U and R may reveal earlier edits
+    :return: (the remaining commands, for each of them whether it may be merged, how many were dropped)
+    """
+    coverage = _Coverage()
+    # an undo or redo reveals earlier edits one by one, so back to the matrix creation they are all kept as they are
+    undo_ahead = False
+    kept = []
+    dropped = 0
+    for command, size in zip(reversed(commands), reversed(sizes)):
+        optimizable = size is not None and not undo_ahead
+        if command.name == 'I':
+            if _creates_matrix(command):
+                coverage.cover_everything()
+                undo_ahead = False
+        elif command.name == 'C':
+            if optimizable:
+                if coverage.everything:
+                    dropped += 1
+                    continue
+                coverage.cover_everything()
+        elif optimizable and _always_paints(command, size):
+            footprint = command.footprint()
+            if all(coverage.covers(segment) for segment in footprint):
+                dropped += 1
+                continue
+            for segment in footprint:
+                coverage.add(segment)
+            kept.append((command, True))
+            continue
+        elif command.name is not None and command.footprint() is None:
+            # e.g. S, P and F read the whole matrix, and O or G may fail and leave it as it is
+            coverage.reset()
+            undo_ahead = undo_ahead or (history and command.name in ('U', 'R'))
+        kept.append((command, False))
+    kept.reverse()
+    return [command for command, _ in kept], [mergeable for _, mergeable in kept], dropped
+
+
+def _segment_command(direction: str, fixed: int, start: int, end: int, color: str,
+                     line_number: int) -> CompiledCommand:
+    """
+    Builds the L, H or V command painting a segment
+    :param direction: 'h' for a segment along row fixed, 'v' for one along column fixed
+    :param fixed: the row or column of the segment
+    :param start: where the segment starts
+    :param end: where the segment ends, inclusive
+    :param color: the color to paint the segment with
+    :param line_number: the line number to report the command errors at
+    :return: the compiled command
+    """
+    if start == end:
+        name, args = 'L', ((start, fixed, color) if direction == 'h' else (fixed, start, color))
+    elif direction == 'h':
+        name, args = 'H', (start, end, fixed, color)
+    else:
+        name, args = 'V', (fixed, start, end, color)
+    spec = COMMANDS[name]
+    return CompiledCommand(name=name, handler=spec.handler, args=args, needs_editor=spec.needs_editor,
+                           line_number=line_number)
+
+
+def _merge_candidates(command: CompiledCommand) -> list:
+    """
+    Gets the segments a merge may see a command as: an L pixel is both a row and a column segment
+    :param command: an L, H or V command
+    :return: list of ('h', y, x1, x2) and ('v', x, y1, y2)
+    """
+    (direction, fixed, start, end), = command.footprint()
+    if command.name == 'L':
+        return [('h', fixed, start, end), ('v', start, fixed, fixed)]
+    return [(direction, fixed, start, end)]
+
+
+def _merge_segments(commands: list, mergeable: list) -> tuple:
+    """
+    Merges back to back L, H and V commands of the same color painting touching pixels of a row or column
+    :param commands: list of CompiledCommand
+    :param mergeable: for each command, whether it may be merged
+    :return: (the merged commands, how many commands were merged away)
+    """
+    merged_commands = []
+    merged = 0
+    # the command being grown, and the segments it may be seen as
+    pending_command = None
+    pending_segments = None
+
+    for command, can_merge in zip(commands, mergeable):
+        if not can_merge or command.name not in ('L', 'H', 'V'):
+            if pending_command is not None:
+                merged_commands.append(pending_command)
+                pending_command = None
+            merged_commands.append(command)
+            continue
+
+        segments = _merge_candidates(command)
+        joined = None
+        if pending_command is not None and pending_command.args[-1] == command.args[-1]:
+            for direction, fixed, start, end in pending_segments:
+                for segment_direction, segment_fixed, segment_start, segment_end in segments:
+                    if segment_direction == direction and segment_fixed == fixed and \
+                            segment_start <= end + 1 and segment_end >= start - 1:
+                        joined = (direction, fixed, min(start, segment_start), max(end, segment_end))
+                        break
+                if joined is not None:
+                    break
+
+        if joined is None:
+            if pending_command is not None:
+                merged_commands.append(pending_command)
+            pending_command = command
+            pending_segments = segments
+        else:
+            pending_command = _segment_command(*joined, color=command.args[-1],
+                                               line_number=pending_command.line_number)
+            pending_segments = _merge_candidates(pending_command)
+            merged += 1
+
+    if pending_command is not None:
+        merged_commands.append(pending_command)
+    return merged_commands, merged
+
+
+def _ends_stretch(command: CompiledCommand, history: bool) -> bool:
+    """
+    Checks if the commands up to command can be optimized without knowing the commands after it:
+    going backwards, the optimization forgets everything it knew at command
+    :param command: the command to check
+    :param history: whether the matrices keep an undo history, so U and R may reveal earlier edits
+    :return:
+    """
+    if command.name == 'I':
+        # nothing undoes past the creation of a matrix
+        return _creates_matrix(command)
+    return not history and command.name not in (None, 'C') and command.footprint() is None
+
+
+class OptimizedStream(object):
+    """
+    Optimizes compiled commands as they stream in, as optimize_commands does, one stretch at a time:
+    a stretch ends at each I command and, without undo history, at each command reading the matrix
+    (e.g. S, P or F). Only the commands of the stretch being read are held at once, so with history the whole
+    matrix life, from one I command to the next, is held before any of its commands is yielded
+    """
+    def __init__(self, commands, history: bool = True):
+        """
+        :param commands: iterable of CompiledCommand, e.g. from compile_script
+        :param history: whether the matrices keep an undo history, so U and R may reveal earlier edits
+        """
+        self._commands = commands
+        self._history = history
+        # what was removed from the stretches yielded so far. Final once the X command or the last command is
+        self.report = OptimizationReport(total=0, unreachable=0, overwritten=0, merged=0)
+
+    def __iter__(self):
+        commands = iter(self._commands)
+        size = None
+        stretch = []
+        for command in commands:
+            stretch.append(command)
+            if command.name == 'X':
+                # read the rest now, as the commands run stop at the X command before the report is complete
+                unreachable = sum(1 for _ in commands)
+                self.report = self.report._replace(total=self.report.total + unreachable, unreachable=unreachable)
+                break
+            if _ends_stretch(command, self._history):
+                size = yield from self._optimize_stretch(stretch, size)
+                stretch = []
+        yield from self._optimize_stretch(stretch, size)
+
+    def _optimize_stretch(self, stretch: list, size: tuple):
+        """
+        Optimizes a stretch, counting what it removed in the report before yielding its commands
+        :param stretch: list of CompiledCommand
+        :param size: (width, height) of the matrix the first command runs on, None if unknown or there is no matrix
+        :return: generator of the optimized commands, returning the size of the matrix left by the stretch
+        """
+        sizes, size = _matrix_sizes(stretch, size)
+        remaining_commands, mergeable, overwritten = _eliminate_overwritten(stretch, sizes, self._history)
+        optimized_commands, merged = _merge_segments(remaining_commands, mergeable)
+        self.report = self.report._replace(total=self.report.total + len(stretch),
+                                           overwritten=self.report.overwritten + overwritten,
+                                           merged=self.report.merged + merged)
+        yield from optimized_commands
+        return size
+
+
+def optimize_commands(commands, history: bool = True) -> tuple:
+    """
+    Rewrites compiled commands into fewer ones painting the same matrices, saving the same files and
+    reporting the same errors. Commands after the first X are dropped, commands whose pixels are all painted over
+    before the matrix is next read (by S, P, F or the end of the script) are dropped, and back to back L, H and V
+    commands of the same color along a row or column are merged.
+    Commands that may fail, e.g. out of bounds or on a matrix of unknown size, are kept as they are, and so is
+    everything before an U or R command back to where its matrix was created, unless there is no undo history
+    :param commands: iterable of CompiledCommand, e.g. from compile_script
+    :param history: whether the matrices keep an undo history, so U and R may reveal earlier edits
+    :return: (list of CompiledCommand, OptimizationReport)
+    """
+    optimized_stream = OptimizedStream(commands, history=history)
+    optimized_commands = list(optimized_stream)
+    return optimized_commands, optimized_stream.report
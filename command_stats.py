@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import time
+
+
+class PeakTrackingList(list):
+    """
+    List remembering the most items it ever held, for queues whose peak size matters
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.peak = len(self)
+
+    def append(self, item):
+        super().append(item)
+        if len(self) > self.peak:
+            self.peak = len(self)
+
+
+class InstrumentedCommand(object):
+    """
+    Wraps a CompiledCommand, recording how it runs in a CommandStats
+    """
+    __slots__ = ('command', 'stats')
+
+    def __init__(self, command, stats: 'CommandStats'):
+        self.command = command
+        self.stats = stats
+
+    @property
+    def name(self):
+        return self.command.name
+
+    @property
+    def args(self):
+        return self.command.args
+
+    @property
+    def line_number(self):
+        return self.command.line_number
+
+    def footprint(self) -> tuple:
+        return self.command.footprint()
+
+    def __call__(self, editor):
+        """
+        Runs the command, timing it and counting the pixels it touches
+        :param editor: the matrix editor to run the command on
+        :return: the matrix editor to run the next command on, which records its pixels in the same stats
+        """
+        stats = self.stats
+        pixels_before = stats.pixels_touched
+        start = time.perf_counter()
+        try:
+            next_editor = self.command(editor)
+        except Exception:
+            stats.record(self.name, time.perf_counter() - start, stats.pixels_touched - pixels_before, failed=True)
+            raise
+        stats.record(self.name, time.perf_counter() - start, stats.pixels_touched - pixels_before)
+        if next_editor is not editor and next_editor is not None:
+            next_editor.enable_stats(stats)
+        return next_editor
+
+
+class CommandStats(object):
+    """
+    Opt-in profile of the commands run on matrix editors: how many ran of each kind, how long they took and how
+    many pixels they touched, plus how big the F fill queues got.
+    Editors only feed it once given to MatrixEditor.enable_stats, and commands only once wrapped by instrument
+    """
+    def __init__(self):
+        # command name -> totals over the commands of that name. Failed compilations are named None
+        self.counts = {}
+        self.failures = {}
+        self.seconds = {}
+        self.pixels = {}
+        # running total of the pixels painted or saved by the editors fed by these stats
+        self.pixels_touched = 0
+        self.fills = 0
+        self.fill_peak_queue = 0
+
+    def instrument(self, commands):
+        """
+        Wraps commands so running them records them in these stats
+        :param commands: iterable of CompiledCommand, e.g. from compile_script
+        :return: generator of InstrumentedCommand
+        """
+        for command in commands:
+            yield InstrumentedCommand(command, self)
+
+    def record(self, name: str, seconds: float, pixels: int, failed: bool = False):
+        """
+        Records a command run
+        :param name: the command name
+        :param seconds: how long the command took
+        :param pixels: how many pixels the command touched
+        :param failed: whether the command raised an error
+        :return:
+        """
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.pixels[name] = self.pixels.get(name, 0) + pixels
+        if failed:
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    def record_fill(self, pixels: int, peak_queue: int = 0):
+        """
+        Records an F fill
+        :param pixels: how many pixels the fill painted
+        :param peak_queue: the most spans the fill had queued at once
+        :return:
+        """
+        self.pixels_touched += pixels
+        self.fills += 1
+        if peak_queue > self.fill_peak_queue:
+            self.fill_peak_queue = peak_queue
+
+    def as_dict(self) -> dict:
+        """
+        Gets the stats as plain data, ready to be dumped as JSON
+        :return: dict of the per command totals, hottest command first, and the fill totals
+        """
+        return {
+            'commands': [{'command': name, 'count': self.counts[name], 'failures': self.failures.get(name, 0),
+                          'seconds': self.seconds[name], 'pixels': self.pixels[name]}
+                         for name in sorted(self.counts, key=self.seconds.get, reverse=True)],
+            'fills': self.fills,
+            'fill_peak_queue': self.fill_peak_queue,
+        }
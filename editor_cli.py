@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import argparse
+import json
+import sys
+
+import command_optimizer
+import history
+import parallel_render
+import pipelined_ingest
+from command_stats import CommandStats
+from image_editor import MatrixEditor, command_decoder, compile_script, run_compiled
+from pixel_storage import STORAGE_BACKENDS
+
+
+def _positive_int(value: str) -> int:
+    """
+    Parses a command line option that must be a positive integer, so argparse reports it otherwise
+    :param value: the option value as typed
+    :return: the integer
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError('must be a positive integer. Received: {}'.format(value))
+    return number
+
+
+def main(argv: list = None):
+    """
+    Main function to read and handle commands via stdin, or from a script when one is given
+    :param argv: the command line arguments. Defaults to sys.argv
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Creates, edits and saves a simple ASCII matrix')
+    parser.add_argument('script', nargs='?',
+                        help='command script to run without prompting, "-" to read it from stdin')
+    parser.add_argument('--history', type=_positive_int, metavar='BYTES',
+                        help='undo history size for scripts (the U and R commands). '
+                             'Defaults to {} bytes when prompting, no history for scripts'
+                        .format(history.DEFAULT_HISTORY_LIMIT))
+    parser.add_argument('--workers', type=_positive_int, metavar='N',
+                        help='render scripts on a tiled canvas painted by N processes')
+    parser.add_argument('--tile-size', type=_positive_int, default=1024, metavar='PIXELS',
+                        help='width and height of the tiles painted by each process. Defaults to %(default)s')
+    parser.add_argument('--parse-workers', type=_positive_int, metavar='N',
+                        help='parse scripts in N processes, in chunks, while the commands parsed so far run')
+    parser.add_argument('--optimize', action='store_true',
+                        help='drop and merge the script commands whose work is painted over before it is seen, '
+                             'reporting how many were removed. Commands are held back until the next command '
+                             'reading the matrix (e.g. S or F), or with --history until the next I command')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='profile the commands, saving per command counts, time and pixels touched '
+                             'as JSON in FILE, "-" for stderr')
+    parser.add_argument('--backend', choices=sorted(STORAGE_BACKENDS),
+                        help='pixel store the I command creates matrices with. Defaults to bytearray')
+    arguments = parser.parse_args(argv)
+    if arguments.stats is not None and arguments.workers is not None:
+        parser.error('--stats does not profile the commands painted by --workers')
+    if arguments.history is not None and arguments.workers is not None:
+        parser.error('--history does not record the commands painted by --workers')
+    if arguments.backend is not None and arguments.workers is not None:
+        parser.error('--backend does not apply to the canvas painted by --workers')
+    stats = CommandStats() if arguments.stats is not None else None
+
+    def dump_stats():
+        if stats is None:
+            return
+        if arguments.stats == '-':
+            json.dump(stats.as_dict(), sys.stderr, indent=2)
+            print(file=sys.stderr)
+        else:
+            with open(arguments.stats, 'w') as stats_file:
+                json.dump(stats.as_dict(), stats_file, indent=2)
+
+    def run_script(script_file):
+        if arguments.parse_workers is None:
+            commands = compile_script(script_file)
+        else:
+            commands = pipelined_ingest.ingest_script(script_file, workers=arguments.parse_workers)
+        optimized_stream = None
+        if arguments.optimize:
+            commands = optimized_stream = command_optimizer.OptimizedStream(commands,
+                                                                            history=arguments.history is not None)
+
+        if arguments.workers is None:
+            run_compiled(commands, history_limit=arguments.history, stats=stats, backend=arguments.backend)
+        else:
+            parallel_render.render_compiled(commands, workers=arguments.workers, tile_size=arguments.tile_size)
+        if optimized_stream is not None:
+            report = optimized_stream.report
+            print('optimizer removed {} of {} commands ({} unreachable, {} overwritten, {} merged)'.format(
+                report.removed, report.total, report.unreachable, report.overwritten, report.merged),
+                file=sys.stderr)
+        dump_stats()
+
+    if arguments.script == '-':
+        run_script(sys.stdin if arguments.parse_workers is None else sys.stdin.buffer)
+        return
+    if arguments.script is not None:
+        with open(arguments.script, 'r' if arguments.parse_workers is None else 'rb') as script:
+            run_script(script)
+        return
+
+    editor = object()
+    command = ''
+    while command != 'X':
+        command = str(input('Insert command: '))
+        split_command = command.split(' ')
+        command_result = command_decoder(editor, *split_command, stats=stats, backend=arguments.backend)
+        if command_result is None:
+            print('Unrecognized command')
+        elif type(command_result) is str:
+            print(command_result)
+        elif isinstance(command_result, MatrixEditor):
+            editor = command_result
+            editor.enable_history(memory_limit=arguments.history or history.DEFAULT_HISTORY_LIMIT)
+    dump_stats()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import zlib
+from array import array
+from collections import deque
+
+DEFAULT_HISTORY_LIMIT = 64 << 20
+
+# deltas holding fewer bytes than this are kept as they are, bigger ones are compressed
+_COMPRESSION_THRESHOLD = 64
+
+# rough per-delta cost of the tuple and its fields, on top of the pixel data
+_DELTA_OVERHEAD = 64
+
+SPAN = 'span'
+COLUMN = 'column'
+FILL = 'fill'
+ROWS = 'rows'
+CLEAR = 'clear'
+
+
+def pack_pixels(pixels: bytes) -> tuple:
+    """
+    Packs pixels for the journal, compressing them when that pays off
+    :param pixels: the pixels to pack
+    :return: (compressed, data)
+    """
+    if len(pixels) >= _COMPRESSION_THRESHOLD:
+        compressed_pixels = zlib.compress(pixels, 1)
+        if len(compressed_pixels) < len(pixels):
+            return True, compressed_pixels
+    return False, bytes(pixels)
+
+
+def pack_rows(rows) -> tuple:
+    """
+    Packs whole rows for the journal, compressing them as they come so they are never copied all at once
+    :param rows: iterable of rows
+    :return: (compressed, data)
+    """
+    compressor = zlib.compressobj(1)
+    compressed_rows = [compressor.compress(row) for row in rows]
+    compressed_rows.append(compressor.flush())
+    return True, b''.join(compressed_rows)
+
+
+def unpack_pixels(compressed: bool, data: bytes) -> bytes:
+    return zlib.decompress(data) if compressed else data
+
+
+def pack_spans(spans) -> array:
+    """
+    Packs (y, x1, x2) spans into a flat integer array
+    :param spans: iterable of (y, x1, x2)
+    :return: array of y, x1, x2 triples
+    """
+    packed_spans = array('l')
+    for span in spans:
+        packed_spans.extend(span)
+    return packed_spans
+
+
+class DeltaJournal(object):
+    """
+    Undo/redo history of a matrix, recording for each edit only the pixels it changed, as they were before it.
+    An entry is a list of deltas, each one of:
+    (SPAN, y, x1, compressed, pixels): pixels of row y starting at x1
+    (COLUMN, x, y1, compressed, pixels): pixels of column x starting at y1
+    (FILL, value, spans): every pixel of the packed (y, x1, x2) spans had the same value
+    (ROWS, y1, compressed, pixels): the whole rows starting at y1, back to back
+    (CLEAR, size, held): the matrix was cleared by swapping its pixels out, held is what the pixel store handed
+    over and size how many bytes it holds
+    """
+    def __init__(self, memory_limit: int = DEFAULT_HISTORY_LIMIT):
+        """
+        :param memory_limit: how many bytes the history may take. The oldest entries are dropped past it
+        """
+        if memory_limit <= 0:
+            raise ValueError('History memory limit must be a positive integer. Received: {}'.format(memory_limit))
+        self._memory_limit = memory_limit
+        self._undo_entries = deque()
+        self._redo_entries = []
+        self._memory_used = 0
+        self._pending_entry = []
+
+    @property
+    def memory_used(self):
+        return self._memory_used
+
+    @property
+    def can_undo(self):
+        return len(self._undo_entries) > 0
+
+    @property
+    def can_redo(self):
+        return len(self._redo_entries) > 0
+
+    def record_span(self, y: int, x1: int, pixels: bytes):
+        self._pending_entry.append((SPAN, y, x1) + pack_pixels(pixels))
+
+    def record_column(self, x: int, y1: int, pixels: bytes):
+        self._pending_entry.append((COLUMN, x, y1) + pack_pixels(pixels))
+
+    def record_fill(self, value: int, spans: array):
+        self._pending_entry.append((FILL, value, spans))
+
+    def record_rows(self, y1: int, rows):
+        self._pending_entry.append((ROWS, y1) + pack_rows(rows))
+
+    def record_clear(self, size: int, held):
+        self._pending_entry.append((CLEAR, size, held))
+
+    def commit(self):
+        """
+        Closes the edit being recorded as one undo entry. Any redo history is discarded
+        :return:
+        """
+        if not self._pending_entry:
+            return
+        entry = self._pending_entry
+        self._pending_entry = []
+        for redo_entry in self._redo_entries:
+            self._memory_used -= self._entry_size(redo_entry)
+        self._redo_entries = []
+        self._push(self._undo_entries, entry)
+
+    def pop_undo(self) -> list:
+        return self._pop(self._undo_entries)
+
+    def pop_redo(self) -> list:
+        return self._pop(self._redo_entries)
+
+    def push_undo(self, entry: list):
+        self._push(self._undo_entries, entry)
+
+    def push_redo(self, entry: list):
+        self._push(self._redo_entries, entry)
+
+    def _pop(self, entries) -> list:
+        if not entries:
+            return None
+        entry = entries.pop()
+        self._memory_used -= self._entry_size(entry)
+        return entry
+
+    def _push(self, entries, entry: list):
+        """
+        Stores entry, dropping the oldest undo entries while the history is over its memory limit
+        :param entries: the undo or redo entries
+        :param entry: the entry to store
+        :return:
+        """
+        entry_size = self._entry_size(entry)
+        if entry_size > self._memory_limit:
+            # an entry can only be undone on top of the ones after it, so nothing before it is usable either
+            self._undo_entries.clear()
+            self._redo_entries = []
+            self._memory_used = 0
+            return
+
+        entries.append(entry)
+        self._memory_used += entry_size
+        while self._memory_used > self._memory_limit and self._undo_entries:
+            self._memory_used -= self._entry_size(self._undo_entries.popleft())
+
+    @staticmethod
+    def _entry_size(entry: list) -> int:
+        size = 0
+        for delta in entry:
+            data = delta[-1]
+            if delta[0] == CLEAR:
+                size += _DELTA_OVERHEAD + delta[1]
+            else:
+                size += _DELTA_OVERHEAD + (len(data) * data.itemsize if isinstance(data, array) else len(data))
+        return size
@@ -1,16 +1,110 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
+import mmap
+import os
+import re
+import stat
+import sys
+import tempfile
+import weakref
+from collections import namedtuple
+
+import history
+import snapshot
+from command_stats import InstrumentedCommand, PeakTrackingList
+from pixel_storage import STORAGE_BACKENDS, BytearrayStorage, RowStorage
+from region_index import DEFAULT_MAX_COMPONENTS, RegionIndex
+
+DEFAULT_SAVE_BUFFER_SIZE = 1 << 20
+
+# (device, inode) of each file opened copy-on-write -> its live private mappings. Writing to such a file in place
+# shows through every page of them not copied yet
+_PRIVATE_MAPPINGS = {}
+
+_DIRTY_ROWS_PATTERN = re.compile(b'\x01+')
+
+
+class MatrixRowView(object):
+    """
+    Read/write view over a single row of a MatrixEditor, indexed by X
+    """
+    def __init__(self, editor: 'MatrixEditor', y: int):
+        self._editor = editor
+        self._y = y
+
+    def __len__(self):
+        return self._editor.width
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return list(self)[x]
+        if x < 0:
+            x += self._editor.width
+        if not 0 <= x < self._editor.width:
+            raise IndexError('Coordinate out of bounds')
+        return chr(self._editor._storage.get(x, self._y))
+
+    def __setitem__(self, x: int, color: str):
+        self._editor.color_dot(coordinate=(x, self._y), color=color)
+
+    def __iter__(self):
+        return iter(self._editor._storage.get_row(self._y).decode('latin-1'))
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class MatrixView(object):
+    """
+    Compatibility view exposing the pixel store as a list of rows of one-character strings
+    """
+    def __init__(self, editor: 'MatrixEditor'):
+        self._editor = editor
+
+    def __len__(self):
+        return self._editor.height
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return list(self)[y]
+        if y < 0:
+            y += self._editor.height
+        if not 0 <= y < self._editor.height:
+            raise IndexError('Coordinate out of bounds')
+        return MatrixRowView(self._editor, y)
+
+    def __iter__(self):
+        return (MatrixRowView(self._editor, y) for y in range(self._editor.height))
+
+    def __eq__(self, other):
+        try:
+            return [list(row) for row in self] == [list(row) for row in other]
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr([list(row) for row in self])
 
 
 class MatrixEditor(object):
     """
-    Creates, edits and saves a simple ASCII matrix
+    Creates, edits and saves a simple ASCII matrix.
+    Colors are single ASCII characters, each stored, and saved, as one byte: saved matrices are ASCII text,
+    so they read the same as UTF-8
     """
-    def __init__(self, width: int, height: int):
+    def __init__(self, width: int, height: int, storage: BytearrayStorage = None, backend: str = 'bytearray'):
         """
         Initializes a matrix with width and height, filling it with 0s
         :param width: positive integer for matrix width
         :param height: positive integer for matrix height
+        :param storage: pixel store already holding a width x height matrix, instead of a new one
+        :param backend: the kind of pixel store to create, one of pixel_storage.STORAGE_BACKENDS
         """
         if width > 0 and height > 0:
             self._height = height
@@ -19,7 +113,93 @@ class MatrixEditor(object):
             raise ValueError(
                 'Width and Height must be positive integers. Received height: {} width: {}'.format(height, width))
 
-        self._matrix = [['0' for _ in range(width)] for _ in range(height)]
+        if storage is None:
+            if backend not in STORAGE_BACKENDS:
+                raise ValueError('Backend must be one of {}. Received: {}'.format(sorted(STORAGE_BACKENDS), backend))
+            storage = STORAGE_BACKENDS[backend](width=width, height=height)
+        self._storage = storage
+
+        # one flag per row changed since the last save, and the file that save went to
+        self._dirty_rows = bytearray(height)
+        self._saved_file = None
+        # undo/redo history, only kept once enable_history is called
+        self._journal = None
+        # CommandStats fed with the pixels touched, only once enable_stats is called
+        self._stats = None
+        # regions painted by the fills, only kept once enable_region_index is called
+        self._region_index = None
+
+    @classmethod
+    def load_from_file(cls, file_path: str, copy_on_write: bool = True) -> 'MatrixEditor':
+        """
+        Opens a matrix saved by save_to_file, memory-mapping the file instead of parsing it
+        O command
+        :param file_path: the file path the matrix was saved in
+        :param copy_on_write: edits stay private to the editor if True, otherwise they are written through to the file
+        :return: a matrix editor over the file content
+        """
+        with open(file_path, 'rb' if copy_on_write else 'r+b') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                raise ValueError('Cannot load an empty matrix file')
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY if copy_on_write else mmap.ACCESS_WRITE)
+            if copy_on_write:
+                file_stat = os.fstat(file.fileno())
+                _PRIVATE_MAPPINGS.setdefault((file_stat.st_dev, file_stat.st_ino), weakref.WeakSet()).add(mapped_file)
+
+        try:
+            width, height = cls._mapped_matrix_size(mapped_file)
+        except ValueError:
+            mapped_file.close()
+            raise
+
+        storage = BytearrayStorage(width=width, height=height, buffer=mapped_file, stride=width + 1)
+        editor = cls(width=width, height=height, storage=storage)
+        if copy_on_write:
+            editor._saved_file = (os.path.abspath(file_path), editor._file_signature(file_path))
+        return editor
+
+    @classmethod
+    def load_snapshot(cls, file_path: str, copy_on_write: bool = True, verify: bool = True) -> 'MatrixEditor':
+        """
+        Opens a matrix saved by save_snapshot, without parsing its pixels
+        G command
+        :param file_path: the file path the snapshot was saved in
+        :param copy_on_write: for raw snapshots, edits stay private to the editor if True,
+        otherwise they are written through to the file
+        :param verify: check the pixels against the snapshot checksum
+        :return: a matrix editor over the snapshot pixels
+        """
+        width, height, pixels = snapshot.read_snapshot(file_path, copy_on_write=copy_on_write, verify=verify)
+        return cls(width=width, height=height, storage=BytearrayStorage(width=width, height=height, buffer=pixels))
+
+    @staticmethod
+    def _mapped_matrix_size(mapped_file: mmap.mmap) -> tuple:
+        """
+        Validates that every row of a mapped matrix file has the same width. Raises any necessary Exception
+        :param mapped_file: the mapped matrix file, rows separated by new lines
+        :return: (width, height) of the matrix
+        """
+        size = len(mapped_file)
+        width = mapped_file.find(b'\n')
+        if width == -1:
+            return size, 1
+        if width == 0:
+            raise ValueError('Matrix rows must not be empty')
+
+        stride = width + 1
+        # the last row may or may not end with a new line
+        height, remainder = divmod(size, stride)
+        if remainder == width:
+            height += 1
+        elif remainder != 0:
+            raise ValueError('Every matrix row must have {} pixels'.format(width))
+
+        for row_start in range(stride, size, stride):
+            row_end = row_start + width
+            # the last row may end at the end of the file instead of at a new line
+            if mapped_file.find(b'\n', row_start) != (-1 if row_end == size else row_end):
+                raise ValueError('Every matrix row must have {} pixels'.format(width))
+        return width, height
 
     @property
     def width(self):
@@ -31,7 +211,97 @@ class MatrixEditor(object):
 
     @property
     def matrix(self):
-        return self._matrix
+        return MatrixView(self)
+
+    @property
+    def _matrix(self):
+        return MatrixView(self)
+
+    @_matrix.setter
+    def _matrix(self, rows):
+        """
+        Replaces the whole matrix content with rows, kept for callers that assign the matrix at once
+        :param rows: height sequences of width single character colors
+        :return:
+        """
+        if len(rows) != self.height:
+            raise ValueError('Matrix must have exactly {} rows. Received: {}'.format(self.height, len(rows)))
+        encoded_rows = [bytes(self._verify_color(color) for color in row) for row in rows]
+        if self._journal is not None:
+            self._journal.record_rows(0, self._storage.iter_rows())
+        for y, row in enumerate(encoded_rows):
+            self._storage.put_row(y, row)
+        self._dirty_rows[:] = b'\x01' * self.height
+        if self._region_index is not None:
+            self._region_index.clear()
+        self._end_edit()
+
+    def enable_history(self, memory_limit: int = history.DEFAULT_HISTORY_LIMIT):
+        """
+        Starts keeping the history of the edits, so they can be undone and redone
+        :param memory_limit: how many bytes the history may take. The oldest edits are forgotten past it
+        :return:
+        """
+        self._journal = history.DeltaJournal(memory_limit=memory_limit)
+
+    def fork(self) -> 'MatrixEditor':
+        """
+        Copies the matrix in O(height): the copy shares every row with this matrix until either of them writes to it.
+        A pixel store that cant be forked is first moved, once, to a row store with a copy of the pixels,
+        so a matrix opened with copy_on_write=False stops writing through to its file
+        :return: the copy, without undo history, stats or region index
+        """
+        if not hasattr(self._storage, 'fork'):
+            self._storage = RowStorage(width=self.width, height=self.height,
+                                       rows=[bytearray(row) for row in self._storage.iter_rows()])
+        forked_editor = type(self)(width=self.width, height=self.height, storage=self._storage.fork())
+        # both matrices differ from the last saved file in the same rows
+        forked_editor._dirty_rows[:] = self._dirty_rows
+        forked_editor._saved_file = self._saved_file
+        return forked_editor
+
+    def enable_stats(self, stats):
+        """
+        Starts counting the pixels the edits paint and the saves write, and profiling the F fills, in stats
+        :param stats: a command_stats.CommandStats
+        :return:
+        """
+        self._stats = stats
+
+    def enable_region_index(self, max_components: int = DEFAULT_MAX_COMPONENTS):
+        """
+        Starts remembering the regions painted by the fills, so filling one of them again only repaints its spans
+        instead of searching for it. Any edit within a region or around it forgets it
+        :param max_components: how many regions to remember. The oldest ones are forgotten past it
+        :return:
+        """
+        self._region_index = RegionIndex(max_components=max_components)
+
+    def undo(self):
+        """
+        Undoes the last edit
+        U command
+        :return:
+        """
+        if self._journal is None:
+            raise ValueError('History is disabled')
+        entry = self._journal.pop_undo()
+        if entry is None:
+            raise ValueError('Nothing to undo')
+        self._journal.push_redo(self._apply_deltas(entry))
+
+    def redo(self):
+        """
+        Redoes the last undone edit
+        R command
+        :return:
+        """
+        if self._journal is None:
+            raise ValueError('History is disabled')
+        entry = self._journal.pop_redo()
+        if entry is None:
+            raise ValueError('Nothing to redo')
+        self._journal.push_undo(self._apply_deltas(entry))
 
     def clear_matrix(self):
         """
@@ -39,9 +309,21 @@ class MatrixEditor(object):
         C command
         :return:
         """
-        for row in range(self.width):
-            for col in range(self.height):
-                self.matrix[col][row] = '0'
+        if self._journal is None:
+            self._storage.clear()
+        elif hasattr(self._storage, 'swap_generation'):
+            # lazy stores clear in O(1) by handing their rows over, and undo hands them back
+            held = self._storage.swap_generation()
+            self._journal.record_clear(len(held[1]) * self.width, held)
+        else:
+            self._journal.record_rows(0, self._storage.iter_rows())
+            self._storage.clear()
+        self._dirty_rows[:] = b'\x01' * self.height
+        if self._region_index is not None:
+            self._region_index.clear()
+        if self._stats is not None:
+            self._stats.pixels_touched += self.width * self.height
+        self._end_edit()
 
     def color_dot(self, coordinate: tuple, color: str):
         """
@@ -52,8 +334,9 @@ class MatrixEditor(object):
         :return:
         """
         self._verify_coordinate(coordinate=coordinate)
-        self._verify_color(color=color)
-        self._matrix[coordinate[1]][coordinate[0]] = color
+        value = self._verify_color(color=color)
+        self._paint_span(coordinate[1], coordinate[0], coordinate[0], value)
+        self._end_edit()
 
     def draw_line(self, direction: str, a_dot_coordinate: tuple, b_dot_coordinate: tuple, color: str):
         """
@@ -69,41 +352,28 @@ class MatrixEditor(object):
             if a_dot_coordinate[1] != b_dot_coordinate[1]:
                 raise ValueError('The Y axis of both coordinates must be the same for a horizontal line')
 
-            if a_dot_coordinate[0] > b_dot_coordinate[0]:
-                right_most_dot = a_dot_coordinate
-                left_most_dot = b_dot_coordinate
-            else:
-                right_most_dot = b_dot_coordinate
-                left_most_dot = a_dot_coordinate
-
-            for x in range(left_most_dot[0], right_most_dot[0] + 1):
-                self.color_dot((x, a_dot_coordinate[1]), color=color)
+            left_most_x, right_most_x = sorted((a_dot_coordinate[0], b_dot_coordinate[0]))
+            self._paint_span(a_dot_coordinate[1], left_most_x, right_most_x, value)
 
         def draw_vertical():
             if a_dot_coordinate[0] != b_dot_coordinate[0]:
                 raise ValueError('The X axis of both coordinates must be the same for a vertical line')
 
-            if a_dot_coordinate[1] > b_dot_coordinate[1]:
-                higher_dot = a_dot_coordinate
-                lesser_dot = b_dot_coordinate
-            else:
-                higher_dot = b_dot_coordinate
-                lesser_dot = a_dot_coordinate
-
-            for y in range(lesser_dot[1], higher_dot[1] + 1):
-                self.color_dot((a_dot_coordinate[0], y), color=color)
+            lesser_y, higher_y = sorted((a_dot_coordinate[1], b_dot_coordinate[1]))
+            self._paint_column(a_dot_coordinate[0], lesser_y, higher_y, value)
 
         if direction not in ('v', 'h'):
             raise ValueError('Direction must be either "v" (vertical) or "h" (horizontal)')
 
         self._verify_coordinate(a_dot_coordinate)
         self._verify_coordinate(b_dot_coordinate)
-        self._verify_color(color=color)
+        value = self._verify_color(color=color)
 
         if direction == 'v':
             draw_vertical()
         else:
             draw_horizontal()
+        self._end_edit()
 
     def draw_rect(self, upper_left_corner_coordinate: tuple, lower_right_corner_coordinate: tuple, color: str):
         """
@@ -114,79 +384,398 @@ class MatrixEditor(object):
         :param color: the character to draw the rectangle with
         :return:
         """
-        upper_right_corner_coordinate = (lower_right_corner_coordinate[0], upper_left_corner_coordinate[1])
-        lower_left_corner_coordinate = (upper_left_corner_coordinate[0], lower_right_corner_coordinate[1])
-
+        # the other two corners are within bounds whenever these two are
         self._verify_coordinate(upper_left_corner_coordinate)
         self._verify_coordinate(lower_right_corner_coordinate)
-        self._verify_coordinate(upper_right_corner_coordinate)
-        self._verify_coordinate(lower_left_corner_coordinate)
-
-        # upper row
-        self.draw_line(direction='h',
-                       a_dot_coordinate=upper_left_corner_coordinate,
-                       b_dot_coordinate=upper_right_corner_coordinate,
-                       color=color)
-        # right column
-        self.draw_line(direction='v',
-                       a_dot_coordinate=upper_right_corner_coordinate,
-                       b_dot_coordinate=lower_right_corner_coordinate,
-                       color=color)
-        # bottom row
-        self.draw_line(direction='h',
-                       a_dot_coordinate=lower_right_corner_coordinate,
-                       b_dot_coordinate=lower_left_corner_coordinate,
-                       color=color)
-        # left column
-        self.draw_line(direction='v',
-                       a_dot_coordinate=lower_left_corner_coordinate,
-                       b_dot_coordinate=upper_left_corner_coordinate,
-                       color=color)
-
-    def color_region(self, dot_within_coordinate: tuple, color: str):
+        value = self._verify_color(color=color)
+
+        for direction, fixed, start, end in _rect_segments(*upper_left_corner_coordinate,
+                                                           *lower_right_corner_coordinate):
+            if direction == 'h':
+                self._paint_span(fixed, start, end, value)
+            else:
+                self._paint_column(fixed, start, end, value)
+        self._end_edit()
+
+    def paint_segments(self, segments, color: str):
+        """
+        Paints segments with color as a single edit, verifying only the bounding box of all of them, once
+        L, V, H & K commands
+        :param segments: ('h', y, x1, x2) and ('v', x, y1, y2) segments, with x1 <= x2 and y1 <= y2
+        :param color: the color to paint the segments with
+        :return:
+        """
+        self._verify_bounding_box(segments)
+        value = self._verify_color(color=color)
+        for direction, fixed, start, end in segments:
+            if direction == 'h':
+                self._paint_span(fixed, start, end, value)
+            else:
+                self._paint_column(fixed, start, end, value)
+        self._end_edit()
+
+    def color_region(self, dot_within_coordinate: tuple, color: str, connectivity: int = 8):
         """
         Colors a region around the dot with color
         F command
         :param dot_within_coordinate: Coordinate to the dot with the region
         :param color: the color to paint with
+        :param connectivity: 8 to spread ink diagonally as well, 4 to spread it only across edges
         :return:
         """
-        def spread_ink(pixel_coordinate: tuple):
-            for x in range(pixel_coordinate[0] - 1, pixel_coordinate[0] + 2):
-                for y in range(pixel_coordinate[1] - 1, pixel_coordinate[1] + 2):
-                    if 0 <= x < self.width and 0 <= y < self.height:
-                        if self.matrix[y][x] == previous_color:
-                            self.matrix[y][x] = color
-                            pixels_to_visit.append((x, y))
+        if connectivity not in (4, 8):
+            raise ValueError('Connectivity must be either 4 or 8')
 
         self._verify_coordinate(dot_within_coordinate)
-        self._verify_color(color)
+        value = self._verify_color(color)
+
+        x, y = dot_within_coordinate
+        previous_color = self._storage.get(x, y)
+        if previous_color == value:
+            return
+
+        component = self._region_index.find(x, y, connectivity) if self._region_index is not None else None
+        if component is not None:
+            self._recolor_component(component, previous_color, value)
+            return
+
+        fill_region = getattr(self._storage, 'fill_region', None)
+        if fill_region is not None:
+            filled_spans = fill_region(x, y, value, connectivity)
+            for filled_y in filled_spans[0::3]:
+                self._dirty_rows[filled_y] = 1
+            if self._journal is not None:
+                self._journal.record_fill(previous_color, filled_spans)
+            if self._stats is not None:
+                self._stats.record_fill(sum(filled_spans[2::3]) - sum(filled_spans[1::3]) + len(filled_spans) // 3)
+            if self._region_index is not None:
+                self._index_region(filled_spans, value, connectivity)
+            self._end_edit()
+            return
+
+        # spans are painted as soon as they are found, so they are never queued twice
+        reach = 1 if connectivity == 8 else 0
+        (span_start, span_end), = self._storage.find_runs(y, x, x, previous_color)
+        self._storage.fill_span(y, span_start, span_end, value)
+        self._dirty_rows[y] = 1
+        spans_to_visit = [(y, span_start, span_end)]
+        if self._stats is not None:
+            spans_to_visit = PeakTrackingList(spans_to_visit)
+        # the history and the region index only need where the region was, all of it had previous_color
+        keep_spans = self._journal is not None or self._stats is not None or self._region_index is not None
+        filled_spans = list(spans_to_visit) if keep_spans else None
+
+        while spans_to_visit:
+            y, span_start, span_end = spans_to_visit.pop()
+            window_start = max(span_start - reach, 0)
+            window_end = min(span_end + reach, self.width - 1)
+            for neighbour_y in (y - 1, y + 1):
+                if 0 <= neighbour_y < self.height:
+                    for run_start, run_end in self._storage.find_runs(neighbour_y, window_start, window_end,
+                                                                      previous_color):
+                        self._storage.fill_span(neighbour_y, run_start, run_end, value)
+                        self._dirty_rows[neighbour_y] = 1
+                        spans_to_visit.append((neighbour_y, run_start, run_end))
+                        if filled_spans is not None:
+                            filled_spans.append((neighbour_y, run_start, run_end))
+
+        if filled_spans is not None:
+            filled_spans = history.pack_spans(filled_spans)
+        if self._journal is not None:
+            self._journal.record_fill(previous_color, filled_spans)
+        if self._stats is not None:
+            self._stats.record_fill(sum(filled_spans[2::3]) - sum(filled_spans[1::3]) + len(filled_spans) // 3,
+                                    spans_to_visit.peak)
+        if self._region_index is not None:
+            self._index_region(filled_spans, value, connectivity)
+        self._end_edit()
+
+    def _recolor_component(self, component, previous_color: int, value: int):
+        """
+        Fills a region known to the region index, repainting its spans without searching for it
+        :param component: the region_index.Component holding the fill seed
+        :param previous_color: the byte value the region has
+        :param value: the byte value to paint it with
+        :return:
+        """
+        self._region_index.remove(component)
+        spans = component.spans
+        for span_idx in range(0, len(spans), 3):
+            y, x1, x2 = spans[span_idx:span_idx + 3]
+            self._storage.fill_span(y, x1, x2, value)
+            self._dirty_rows[y] = 1
+        # the regions around it saw their boundary change color
+        self._region_index.invalidate_spans(spans)
+        self._region_index.recolor(component, value)
 
-        pixels_to_visit = [dot_within_coordinate]
-        previous_color = self.matrix[dot_within_coordinate[1]][dot_within_coordinate[0]]
+        if self._journal is not None:
+            self._journal.record_fill(previous_color, spans)
+        if self._stats is not None:
+            self._stats.record_fill(sum(spans[2::3]) - sum(spans[1::3]) + len(spans) // 3)
+        self._end_edit()
 
-        while len(pixels_to_visit) > 0:
-            spread_ink(pixels_to_visit.pop(0))
+    def _index_region(self, filled_spans, value: int, connectivity: int):
+        """
+        Remembers a region a fill just searched for and painted
+        :param filled_spans: the painted spans, as a flat array of y, x1, x2 triples
+        :param value: the byte value the region was painted with
+        :param connectivity: the connectivity of the fill
+        :return:
+        """
+        # the regions around it saw their boundary change color
+        self._region_index.invalidate_spans(filled_spans)
+        self._region_index.add(self._storage, filled_spans, value, connectivity)
 
-    def save_to_file(self, file_path: str):
+    def save_to_file(self, file_path: str, buffer_size: int = DEFAULT_SAVE_BUFFER_SIZE, atomic: bool = True,
+                     incremental: bool = False):
         """
-        Saves the matrix in a file
+        Saves the matrix in a file, streaming it row by row straight from the pixel store
         :param file_path: the file path to save the matrix in
+        :param buffer_size: how many bytes to buffer before each write to the file
+        :param atomic: write to a temporary file next to file_path and rename it over file_path once complete,
+        so a failed save never leaves a truncated file behind
+        :param incremental: if file_path is unchanged since this matrix was last saved in it, and no other matrix
+        opened it copy-on-write, only overwrite the rows changed since then, in place
+        :return:
+        """
+        if incremental and self._saved_file == (os.path.abspath(file_path), self._file_signature(file_path)) and \
+                not self._mapped_by_others(file_path):
+            self._save_dirty_rows(file_path=file_path, buffer_size=buffer_size)
+        elif not atomic:
+            with open(file_path, 'wb', buffering=buffer_size) as file:
+                self._write_rows(file, 0, self.height)
+        else:
+            self._save_atomically(file_path=file_path, buffer_size=buffer_size)
+
+        self._saved_file = (os.path.abspath(file_path), self._file_signature(file_path))
+        self._dirty_rows = bytearray(self.height)
+
+    def save_snapshot(self, file_path: str, encoding: str = snapshot.RAW,
+                      buffer_size: int = DEFAULT_SAVE_BUFFER_SIZE):
+        """
+        Saves the matrix in a binary snapshot: a header with its size and checksum, then its pixels as they are
+        stored, raw or zlib compressed. Written to a temporary file renamed over file_path once complete
+        P command
+        :param file_path: the file path to save the snapshot in
+        :param encoding: snapshot.RAW, quickest to save and load, or snapshot.ZLIB, smallest
+        :param buffer_size: how many bytes to buffer before each write to the file
         :return:
         """
+        self._save_atomically(file_path=file_path, buffer_size=buffer_size,
+                              write_content=lambda file: snapshot.write_snapshot(
+                                  file, self._storage.iter_rows(), width=self.width, height=self.height,
+                                  encoding=encoding))
+
+    def dirty_row_ranges(self) -> list:
+        """
+        Gets the rows changed since the last save
+        :return: list of (first, last) inclusive row ranges, top to bottom
+        """
+        return [(match.start(), match.end() - 1) for match in _DIRTY_ROWS_PATTERN.finditer(self._dirty_rows)]
+
+    def _save_atomically(self, file_path: str, buffer_size: int, write_content=None):
+        """
+        Saves the matrix in a temporary file next to file_path, then renames it over file_path
+        :param file_path: the file path to save the matrix in
+        :param buffer_size: how many bytes to buffer before each write to the file
+        :param write_content: writes the matrix to the open temporary file. Defaults to writing its rows as text
+        :return:
+        """
+        # a symbolic link is saved through, as open() would, instead of being replaced by the file
+        file_path = os.path.realpath(file_path)
+        directory, file_name = os.path.split(file_path)
+        file_descriptor, temporary_path = self._create_temporary_file(directory, file_name)
         try:
-            with open(file_path, 'w'):
-                pass
-        except OSError as err:
-            print('Couldnt write file at {}. OSError: {}'.format(file_path, str(err)))
+            with os.fdopen(file_descriptor, 'wb', buffering=buffer_size) as file:
+                if write_content is None:
+                    self._write_rows(file, 0, self.height)
+                else:
+                    write_content(file)
+            file_mode = self._existing_file_mode(file_path)
+            if file_mode is not None:
+                os.chmod(temporary_path, file_mode)
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
 
-        content = []
-        for line_idx in range(self.height):
-            content.append(''.join(self.matrix[line_idx]))
-        content = '\n'.join(content)
+    def _save_dirty_rows(self, file_path: str, buffer_size: int):
+        """
+        Overwrites, in place, the rows changed since the matrix was last saved in file_path
+        :param file_path: the file path the matrix was last saved in
+        :param buffer_size: how many bytes to buffer before each write to the file
+        :return:
+        """
+        with open(file_path, 'r+b', buffering=buffer_size) as file:
+            for first_row, last_row in self.dirty_row_ranges():
+                file.seek(first_row * (self.width + 1))
+                self._write_rows(file, first_row, last_row + 1)
 
-        with open(file_path, 'w') as file:
-            file.write(content)
+    def _write_rows(self, file, start: int, stop: int):
+        """
+        Writes the rows start..stop-1 of the matrix to file, separated by new lines
+        :param file: a file opened for binary writing
+        :param start: the first row to write
+        :param stop: the row to stop before
+        :return:
+        """
+        if self._stats is not None:
+            self._stats.pixels_touched += (stop - start) * self.width
+        rows = self._storage.iter_rows(start, stop)
+        file.write(next(rows))
+        for row in rows:
+            file.write(b'\n')
+            file.write(row)
+
+    def _mapped_by_others(self, file_path: str) -> bool:
+        """
+        Checks whether another matrix opened file_path copy-on-write, so writing to it in place would show in that
+        matrix. This matrix's own mapping is fine: the rows written are the ones it holds already
+        :param file_path: the file path to check
+        :return: True if another live matrix maps the file
+        """
+        file_stat = os.stat(file_path)
+        mappings = _PRIVATE_MAPPINGS.get((file_stat.st_dev, file_stat.st_ino), ())
+        own_buffer = getattr(self._storage, 'buffer', None)
+        return any(mapping is not own_buffer for mapping in mappings)
+
+    @staticmethod
+    def _file_signature(file_path: str):
+        """
+        Gets what changes whenever a file is replaced or modified
+        :param file_path: the file path to sign
+        :return: the signature, None if there is no such file
+        """
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+    @staticmethod
+    def _create_temporary_file(directory: str, file_name: str) -> tuple:
+        """
+        Creates a hidden temporary file in directory with the permissions open() gives new files, 0o666 less the
+        umask, applied by the kernel so the process umask is never changed, even for a moment
+        :param directory: where to create the file
+        :param file_name: the name of the file the temporary one stands for
+        :return: (file descriptor, file path) of the temporary file, opened for writing
+        """
+        for _ in range(tempfile.TMP_MAX):
+            temporary_path = os.path.join(directory, '.{}.{}'.format(file_name, os.urandom(6).hex()))
+            try:
+                return os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), temporary_path
+            except FileExistsError:
+                continue
+        raise FileExistsError('No usable temporary file name found in {}'.format(directory))
+
+    @staticmethod
+    def _existing_file_mode(file_path: str) -> int:
+        """
+        Gets the permissions of the file a matrix is saved over, to keep them as open() would
+        :param file_path: the file path the matrix is saved in
+        :return: the file permission bits, None if there is no such file
+        """
+        try:
+            return stat.S_IMODE(os.stat(file_path).st_mode)
+        except FileNotFoundError:
+            return None
+
+    def _paint_span(self, y: int, x1: int, x2: int, value: int):
+        """
+        Paints the pixels x1..x2 of row y with value. Coordinates must be already verified
+        :param y: the row of the span
+        :param x1: the left-most X of the span
+        :param x2: the right-most X of the span
+        :param value: the byte value to paint with
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.record_span(y, x1, self._storage.get_span(y, x1, x2))
+        if self._stats is not None:
+            self._stats.pixels_touched += x2 - x1 + 1
+        if self._region_index is not None:
+            self._region_index.invalidate_span(y, x1, x2)
+        self._storage.fill_span(y, x1, x2, value)
+        self._dirty_rows[y] = 1
+
+    def _paint_column(self, x: int, y1: int, y2: int, value: int):
+        """
+        Paints the pixels y1..y2 of column x with value. Coordinates must be already verified
+        :param x: the column of the span
+        :param y1: the upper-most Y of the span
+        :param y2: the lower-most Y of the span
+        :param value: the byte value to paint with
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.record_column(x, y1, self._storage.get_column(x, y1, y2))
+        if self._stats is not None:
+            self._stats.pixels_touched += y2 - y1 + 1
+        if self._region_index is not None:
+            self._region_index.invalidate_column(x, y1, y2)
+        self._storage.fill_column(x, y1, y2, value)
+        self._mark_rows_dirty(y1, y2)
+
+    def _mark_rows_dirty(self, first_row: int, last_row: int):
+        self._dirty_rows[first_row:last_row + 1] = b'\x01' * (last_row - first_row + 1)
+
+    def _end_edit(self):
+        """
+        Closes the edit that just happened as one undo step
+        :return:
+        """
+        if self._journal is not None:
+            self._journal.commit()
+
+    def _apply_deltas(self, entry: list) -> list:
+        """
+        Puts back the pixels recorded in a history entry, latest delta first
+        :param entry: the history entry
+        :return: the entry that puts back the pixels as they were before this call
+        """
+        if self._region_index is not None:
+            self._region_index.clear()
+        inverse_entry = []
+        for delta in reversed(entry):
+            kind = delta[0]
+            if kind == history.SPAN:
+                _, y, x1, compressed, data = delta
+                pixels = history.unpack_pixels(compressed, data)
+                x2 = x1 + len(pixels) - 1
+                inverse_entry.append((history.SPAN, y, x1) +
+                                     history.pack_pixels(self._storage.get_span(y, x1, x2)))
+                self._storage.put_span(y, x1, pixels)
+                self._dirty_rows[y] = 1
+            elif kind == history.COLUMN:
+                _, x, y1, compressed, data = delta
+                pixels = history.unpack_pixels(compressed, data)
+                y2 = y1 + len(pixels) - 1
+                inverse_entry.append((history.COLUMN, x, y1) +
+                                     history.pack_pixels(self._storage.get_column(x, y1, y2)))
+                self._storage.put_column(x, y1, pixels)
+                self._dirty_rows[y1:y2 + 1] = b'\x01' * len(pixels)
+            elif kind == history.FILL:
+                _, value, spans = delta
+                inverse_entry.append((history.FILL, self._storage.get(spans[1], spans[0]), spans))
+                for span_idx in range(0, len(spans), 3):
+                    y, x1, x2 = spans[span_idx:span_idx + 3]
+                    self._storage.fill_span(y, x1, x2, value)
+                    self._dirty_rows[y] = 1
+            elif kind == history.CLEAR:
+                held = self._storage.swap_generation(delta[2])
+                inverse_entry.append((history.CLEAR, len(held[1]) * self.width, held))
+                self._dirty_rows[:] = b'\x01' * self.height
+            else:
+                _, y1, compressed, data = delta
+                pixels = history.unpack_pixels(compressed, data)
+                row_count = len(pixels) // self.width
+                inverse_entry.append((history.ROWS, y1) +
+                                     history.pack_rows(self._storage.iter_rows(y1, y1 + row_count)))
+                for row_idx in range(row_count):
+                    self._storage.put_row(y1 + row_idx, pixels[row_idx * self.width:(row_idx + 1) * self.width])
+                self._dirty_rows[y1:y1 + row_count] = b'\x01' * row_count
+        return inverse_entry
 
     def _verify_coordinate(self, coordinate: tuple):
         """
@@ -201,108 +790,354 @@ class MatrixEditor(object):
             :param y: the Y coordinate of the point
             :return: True if valid, False otherwise
             """
-            return self.width >= x and self.height >= y
+            return 0 <= x < self.width and 0 <= y < self.height
 
         if len(coordinate) != 2:
             raise ValueError('Coordinates must be a 2-sized tuple')
         if not is_valid_coordinate(*coordinate):
             raise IndexError('Coordinate out of bounds')
 
+    def _verify_bounding_box(self, segments):
+        """
+        Verifies every pixel of segments is within the matrix, by checking the corners of their bounding box.
+        Raises any necessary Exception
+        :param segments: ('h', y, x1, x2) and ('v', x, y1, y2) segments, with x1 <= x2 and y1 <= y2
+        :return:
+        """
+        xs = []
+        ys = []
+        for direction, fixed, start, end in segments:
+            if direction == 'h':
+                xs += (start, end)
+                ys.append(fixed)
+            else:
+                xs.append(fixed)
+                ys += (start, end)
+        self._verify_coordinate((min(xs), min(ys)))
+        self._verify_coordinate((max(xs), max(ys)))
+
     @staticmethod
-    def _verify_color(color: str):
+    def _verify_color(color: str) -> int:
+        """
+        Verifies the color. Raises any necessary Exception
+        :param color: the color to be verified
+        :return: the byte value the color is stored as
+        """
         if not len(color) == 1:
             raise ValueError('Color param must be a single character')
+        value = ord(color)
+        if value > 0x7f:
+            raise ValueError('Color param must be an ASCII character')
+        return value
+
+
+class UnrecognizedCommandError(ValueError):
+    """
+    Raised when compiling a command whose letter isnt in COMMANDS
+    """
+
+
+def _coordinate(value: str) -> int:
+    """
+    Parses a 1-based command coordinate into a 0-based matrix coordinate
+    :param value: the coordinate as typed in the command
+    :return: the 0-based coordinate
+    """
+    return int(value) - 1
+
+
+def _i_handler(editor, m, n, backend='bytearray'):
+    return MatrixEditor(width=m, height=n, backend=backend)
+
+
+def _o_handler(editor, name):
+    return MatrixEditor.load_from_file(file_path=name)
+
+
+def _s_handler(editor, name):
+    editor.save_to_file(file_path=name, incremental=True)
+    return editor
+
+
+def _g_handler(editor, name):
+    return MatrixEditor.load_snapshot(file_path=name)
+
+
+def _p_handler(editor, name):
+    editor.save_snapshot(file_path=name)
+    return editor
+
+
+def _c_handler(editor):
+    editor.clear_matrix()
+    return editor
+
+
+# L, V, H and K paint their footprint straight away, verifying its bounding box once
+def _l_handler(editor, x, y, c):
+    editor.paint_segments(_l_footprint(x, y, c), color=c)
+    return editor
+
+
+def _v_handler(editor, x, y1, y2, c):
+    editor.paint_segments(_v_footprint(x, y1, y2, c), color=c)
+    return editor
+
 
+def _h_handler(editor, x1, x2, y, c):
+    editor.paint_segments(_h_footprint(x1, x2, y, c), color=c)
+    return editor
 
-def command_decoder(editor: MatrixEditor, command: tuple, *args):
+
+def _k_handler(editor, x1, y1, x2, y2, c):
+    editor.paint_segments(_k_footprint(x1, y1, x2, y2, c), color=c)
+    return editor
+
+
+def _f_handler(editor, x, y, c):
+    editor.color_region(dot_within_coordinate=(x, y), color=c)
+    return editor
+
+
+def _u_handler(editor):
+    editor.undo()
+    return editor
+
+
+def _r_handler(editor):
+    editor.redo()
+    return editor
+
+
+def _x_handler(editor):
+    return editor
+
+
+def _failed_compilation_handler(editor, error):
+    raise error
+
+
+def _l_footprint(x, y, c):
+    return ('h', y, x, x),
+
+
+def _v_footprint(x, y1, y2, c):
+    return ('v', x, min(y1, y2), max(y1, y2)),
+
+
+def _h_footprint(x1, x2, y, c):
+    return ('h', y, min(x1, x2), max(x1, x2)),
+
+
+def _k_footprint(x1, y1, x2, y2, c):
+    return _rect_segments(x1, y1, x2, y2)
+
+
+def _rect_segments(x1, y1, x2, y2) -> tuple:
+    """
+    Splits the outline of a rectangle in segments that share no pixel, so each pixel is painted (and counted) once
+    :return: the upper and bottom rows, then the left and right columns between them
+    """
+    left_x, right_x = sorted((x1, x2))
+    top_y, bottom_y = sorted((y1, y2))
+    segments = [('h', top_y, left_x, right_x)]
+    if bottom_y > top_y:
+        segments.append(('h', bottom_y, left_x, right_x))
+    if bottom_y - top_y > 1:
+        segments.append(('v', left_x, top_y + 1, bottom_y - 1))
+        if right_x > left_x:
+            segments.append(('v', right_x, top_y + 1, bottom_y - 1))
+    return tuple(segments)
+
+
+# footprint: for commands that paint fixed pixels, whatever the matrix holds, returns the
+# ('h', y, x1, x2) and ('v', x, y1, y2) segments they paint with their last argument
+CommandSpec = namedtuple('CommandSpec', ['handler', 'arg_types', 'needs_editor', 'footprint'], defaults=(None, ))
+
+# command letter -> how to parse its arguments and what to run with them
+COMMANDS = {
+    'I': CommandSpec(handler=_i_handler, arg_types=(int, int), needs_editor=False),
+    'C': CommandSpec(handler=_c_handler, arg_types=(), needs_editor=True),
+    'L': CommandSpec(handler=_l_handler, arg_types=(_coordinate, _coordinate, str), needs_editor=True,
+                     footprint=_l_footprint),
+    'V': CommandSpec(handler=_v_handler, arg_types=(_coordinate, _coordinate, _coordinate, str), needs_editor=True,
+                     footprint=_v_footprint),
+    'H': CommandSpec(handler=_h_handler, arg_types=(_coordinate, _coordinate, _coordinate, str), needs_editor=True,
+                     footprint=_h_footprint),
+    'K': CommandSpec(handler=_k_handler, arg_types=(_coordinate, _coordinate, _coordinate, _coordinate, str),
+                     needs_editor=True, footprint=_k_footprint),
+    'F': CommandSpec(handler=_f_handler, arg_types=(_coordinate, _coordinate, str), needs_editor=True),
+    'O': CommandSpec(handler=_o_handler, arg_types=(str, ), needs_editor=False),
+    'S': CommandSpec(handler=_s_handler, arg_types=(str, ), needs_editor=True),
+    'P': CommandSpec(handler=_p_handler, arg_types=(str, ), needs_editor=True),
+    'G': CommandSpec(handler=_g_handler, arg_types=(str, ), needs_editor=False),
+    'U': CommandSpec(handler=_u_handler, arg_types=(), needs_editor=True),
+    'R': CommandSpec(handler=_r_handler, arg_types=(), needs_editor=True),
+    'X': CommandSpec(handler=_x_handler, arg_types=(), needs_editor=False),
+}
+
+
+class CompiledCommand(namedtuple('CompiledCommand', ['name', 'handler', 'args', 'needs_editor', 'line_number'])):
+    """
+    A command decoded once into its handler and typed arguments, ready to be run (or replayed) on an editor
+    """
+    __slots__ = ()
+
+    def __call__(self, editor):
+        """
+        Runs the command
+        :param editor: the matrix editor to run the command on
+        :return: the matrix editor to run the next command on
+        """
+        if self.needs_editor and not isinstance(editor, MatrixEditor):
+            raise ValueError('There is no matrix to edit. Create one with the I command first')
+        return self.handler(editor, *self.args)
+
+    def footprint(self) -> tuple:
+        """
+        Gets the segments the command paints, as in CommandSpec.footprint
+        :return: the segments, None if what the command changes depends on the matrix content
+        """
+        spec = COMMANDS.get(self.name)
+        if spec is None or spec.footprint is None or self.handler is not spec.handler:
+            return None
+        return spec.footprint(*self.args)
+
+
+def compile_command(command: str, *args, line_number: int = None) -> CompiledCommand:
+    """
+    Decodes a command into a CompiledCommand, checking its arity and parsing its arguments
+    :param command: the command name. Only its first letter matters
+    :param args: the arguments of the command, as typed
+    :param line_number: where the command comes from, if it comes from a script
+    :return: the compiled command
+    """
+    name = str(command)[:1].upper()
+    spec = COMMANDS.get(name)
+    if spec is None:
+        raise UnrecognizedCommandError('Unrecognized command')
+    if len(args) != len(spec.arg_types):
+        raise ValueError('{} command expects {} arguments. Received: {}'.format(name, len(spec.arg_types), len(args)))
+    return CompiledCommand(name=name, handler=spec.handler,
+                           args=tuple(arg_type(arg) for arg_type, arg in zip(spec.arg_types, args)),
+                           needs_editor=spec.needs_editor, line_number=line_number)
+
+
+def command_decoder(editor: MatrixEditor, command: str, *args, stats=None, backend: str = None):
     """
     Decodes command and execute it
     :param editor:
     :param command:
     :param args: the arguments of the command
+    :param stats: if given, a command_stats.CommandStats to record the command in
+    :param backend: if given, the pixel store an I command creates its matrix with
     :return: None if command wasnt executed OK
     """
-    def i_handler(m, n):
-        return MatrixEditor(width=int(m), height=int(n))
-
-    def s_handler(name):
-        editor.save_to_file(file_path=name)
+    try:
+        compiled_command = with_backend(compile_command(command, *args), backend)
+        if stats is not None:
+            compiled_command = InstrumentedCommand(compiled_command, stats)
+        editor = compiled_command(editor)
+    except UnrecognizedCommandError:
+        return None
+    except Exception as err:
+        return str(err)
 
-    def c_handler():
-        editor.clear_matrix()
+    if compiled_command.name in ('I', 'O', 'G'):
+        return editor
+    return True
 
-    def l_handler(x, y, c):
-        editor.color_dot(coordinate=(int(x) - 1, int(y) - 1), color=c)
 
-    def v_handler(x, y1, y2, c):
-        editor.draw_line(direction='v',
-                         a_dot_coordinate=(int(x) - 1, int(y1) - 1),
-                         b_dot_coordinate=(int(x) - 1, int(y2) - 1),
-                         color=c)
+def with_backend(command: CompiledCommand, backend: str = None) -> CompiledCommand:
+    """
+    Makes an I command create its matrix on the given pixel store. Other commands are left as they are
+    :param command: the compiled command
+    :param backend: one of pixel_storage.STORAGE_BACKENDS. None leaves the command as it is
+    :return: the compiled command
+    """
+    if backend is None or command.name != 'I':
+        return command
+    return command._replace(args=command.args + (backend, ))
 
-    def h_handler(x1, x2, y, c):
-        editor.draw_line(direction='h',
-                         a_dot_coordinate=(int(x1) - 1, int(y) - 1),
-                         b_dot_coordinate=(int(x2) -1, int(y) - 1), color=c)
 
-    def k_handler(x1, y1, x2, y2, c):
-        editor.draw_rect(upper_left_corner_coordinate=(int(x1) - 1, int(y1) - 1),
-                         lower_right_corner_coordinate=(int(x2) - 1, int(y2) - 1),
-                         color=c)
+def compile_script(lines) -> iter:
+    """
+    Compiles the lines of a command script, skipping the blank ones.
+    Lines that fail to compile become commands that raise their compilation error when run
+    :param lines: iterable of command lines, as read from a file
+    :return: generator of CompiledCommand
+    """
+    for line_number, line in enumerate(lines, start=1):
+        split_command = line.split()
+        if split_command:
+            yield compile_line(split_command, line_number=line_number)
 
-    def f_handler(x, y, c):
-        editor.color_region(dot_within_coordinate=(int(x) - 1, int(y) - 1), color=c)
 
+def compile_line(split_command: list, line_number: int = None) -> CompiledCommand:
+    """
+    Compiles a split command line. A line that fails to compile becomes a command that raises its compilation
+    error when run
+    :param split_command: the command name and arguments, as typed
+    :param line_number: where the command comes from, if it comes from a script
+    :return: the compiled command
+    """
     try:
-        if str(command[0]).upper() == 'I':
-            return i_handler(*args)
-        elif str(command[0]).upper() == 'C':
-            c_handler()
-            return True
-        elif str(command[0]).upper() == 'L':
-            l_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'V':
-            v_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'H':
-            h_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'K':
-            k_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'F':
-            f_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'S':
-            s_handler(*args)
-            return True
-        elif str(command[0]).upper() == 'X':
-            return True
-        else:
-            return None
+        return compile_command(*split_command, line_number=line_number)
     except Exception as err:
-        return str(err)
+        return CompiledCommand(name=None, handler=_failed_compilation_handler,
+                               args=(err, ), needs_editor=False, line_number=line_number)
+
+
+def run_compiled(commands, editor=None, error_stream=None, history_limit: int = None, stats=None,
+                 backend: str = None):
+    """
+    Runs compiled commands, stopping at the first X command
+    :param commands: iterable of CompiledCommand, e.g. from compile_script
+    :param editor: the matrix editor to start with, if the commands dont begin with an I command
+    :param error_stream: where to report failing commands, with their line numbers. Defaults to stderr
+    :param history_limit: if given, keep this many bytes of undo history for each matrix the commands create
+    :param stats: if given, a command_stats.CommandStats to record the commands in
+    :param backend: if given, the pixel store the I commands create their matrices with
+    :return: the matrix editor as left by the commands
+    """
+    if error_stream is None:
+        error_stream = sys.stderr
+    if backend is not None:
+        commands = (with_backend(command, backend) for command in commands)
+    if stats is not None:
+        commands = stats.instrument(commands)
+        if isinstance(editor, MatrixEditor):
+            editor.enable_stats(stats)
+
+    for command in commands:
+        try:
+            next_editor = command(editor)
+            if history_limit is not None and next_editor is not editor:
+                next_editor.enable_history(memory_limit=history_limit)
+            editor = next_editor
+        except Exception as err:
+            print('line {}: {}'.format(command.line_number, err), file=error_stream)
+        if command.name == 'X':
+            break
+    return editor
 
 
-def main():
+def run_batch(lines, editor=None, error_stream=None, history_limit: int = None, stats=None, backend: str = None):
     """
-    Main function to read and handle commands via stdin
-    :return:
+    Executes a command script without prompting, stopping at the first X command
+    :param lines: iterable of command lines, e.g. an open file or sys.stdin
+    :param editor: the matrix editor to start with, if the script doesnt begin with an I command
+    :param error_stream: where to report failing commands, with their line numbers. Defaults to stderr
+    :param history_limit: if given, keep this many bytes of undo history for each matrix the script creates
+    :param stats: if given, a command_stats.CommandStats to record the commands in
+    :param backend: if given, the pixel store the I commands create their matrices with
+    :return: the matrix editor as left by the script
     """
-    editor = object()
-    command = ''
-    while command != 'X':
-        command = str(input('Insert command: '))
-        split_command = command.split(' ')
-        command_result = command_decoder(editor, *split_command)
-        if command_result is None:
-            print('Unrecognized command')
-        elif type(command_result) is str:
-            print(command_result)
-        elif split_command[0].upper() == 'I':
-            editor = command_result
+    return run_compiled(compile_script(lines), editor=editor, error_stream=error_stream,
+                        history_limit=history_limit, stats=stats, backend=backend)
 
 
 if __name__ == '__main__':
-    main()
+    # the command line lives in editor_cli, which imports this module by name as every other module does
+    import editor_cli
+    editor_cli.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from image_editor import MatrixEditor, compile_script
+from pixel_storage import BytearrayStorage
+
+DEFAULT_TILE_SIZE = 1024
+
+# how many segments to queue before rendering them, so long scripts are rendered in bounded memory
+DEFAULT_MAX_PENDING_SEGMENTS = 1 << 18
+
+# the pixel store of the shared matrix, as attached by each worker process
+_worker_memory = None
+_worker_storage = None
+
+
+def _attach_worker(memory_name: str, width: int, height: int):
+    """
+    Attaches a worker process to the shared matrix
+    :param memory_name: the name of the shared memory holding the pixels
+    :param width: the matrix width
+    :param height: the matrix height
+    :return:
+    """
+    global _worker_memory, _worker_storage
+    # workers share the resource tracker of the parent process, which unlinks the memory once done with it
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    _worker_storage = BytearrayStorage(width=width, height=height, buffer=_worker_memory.buf[:width * height])
+
+
+def _render_segments(storage: BytearrayStorage, segments: list):
+    """
+    Paints segments, in order
+    :param storage: the pixel store to paint on
+    :param segments: list of ('h', y, x1, x2, value) and ('v', x, y1, y2, value), already within bounds
+    :return:
+    """
+    for direction, fixed, start, end, value in segments:
+        if direction == 'h':
+            storage.fill_span(fixed, start, end, value)
+        else:
+            storage.fill_column(fixed, start, end, value)
+
+
+def _render_tile(segments: list) -> int:
+    _render_segments(_worker_storage, segments)
+    return len(segments)
+
+
+def plan_tiles(segments, tile_width: int, tile_height: int) -> dict:
+    """
+    Splits segments along tile boundaries, keeping their order within each tile.
+    Segments that dont share a tile can then be painted in any order, or at the same time
+    :param segments: iterable of ('h', y, x1, x2, value) and ('v', x, y1, y2, value)
+    :param tile_width: the width of the tiles
+    :param tile_height: the height of the tiles
+    :return: dict of (tile column, tile row) -> list of clipped segments
+    """
+    tiles = {}
+    for direction, fixed, start, end, value in segments:
+        if direction == 'h':
+            tile_row = fixed // tile_height
+            for tile_column in range(start // tile_width, end // tile_width + 1):
+                clipped = ('h', fixed, max(start, tile_column * tile_width),
+                           min(end, (tile_column + 1) * tile_width - 1), value)
+                tiles.setdefault((tile_column, tile_row), []).append(clipped)
+        else:
+            tile_column = fixed // tile_width
+            for tile_row in range(start // tile_height, end // tile_height + 1):
+                clipped = ('v', fixed, max(start, tile_row * tile_height),
+                           min(end, (tile_row + 1) * tile_height - 1), value)
+                tiles.setdefault((tile_column, tile_row), []).append(clipped)
+    return tiles
+
+
+class TiledCanvas(object):
+    """
+    A matrix editor whose pixels live in shared memory, split in tiles that a pool of processes paints in parallel
+    """
+    def __init__(self, width: int, height: int, tile_width: int = DEFAULT_TILE_SIZE,
+                 tile_height: int = DEFAULT_TILE_SIZE, workers: int = None,
+                 max_pending_segments: int = DEFAULT_MAX_PENDING_SEGMENTS):
+        """
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :param tile_width: the width of the tiles the matrix is split in
+        :param tile_height: the height of the tiles the matrix is split in
+        :param workers: how many processes paint the tiles. Defaults to the number of CPUs
+        :param max_pending_segments: how many segments to queue before rendering them
+        """
+        if tile_width <= 0 or tile_height <= 0:
+            raise ValueError('Tile width and height must be positive integers. '
+                             'Received height: {} width: {}'.format(tile_height, tile_width))
+        self._tile_width = tile_width
+        self._tile_height = tile_height
+        self._workers = workers if workers is not None else os.cpu_count() or 1
+        self._max_pending_segments = max_pending_segments
+        self._memory = None
+        self._shared_buffer = None
+        self._pool = None
+        self.editor = None
+        self._allocate(width, height)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def render(self, commands, error_stream=None):
+        """
+        Runs compiled commands, stopping at the first X command.
+        L, V, H and K commands are queued and painted tile by tile in parallel. Any other command,
+        e.g. an F fill whose region may cross tiles, first waits for the queued ones and then runs on the whole matrix
+        :param commands: iterable of CompiledCommand, e.g. from compile_script
+        :param error_stream: where to report failing commands, with their line numbers. Defaults to stderr
+        :return: the matrix editor, holding the rendered matrix
+        """
+        if error_stream is None:
+            error_stream = sys.stderr
+
+        pending_segments = []
+        for command in commands:
+            try:
+                footprint = command.footprint()
+                if footprint is not None:
+                    pending_segments.extend(self._verified_segments(footprint, command.args[-1]))
+                    if len(pending_segments) >= self._max_pending_segments:
+                        self._render_pending(pending_segments)
+                        pending_segments = []
+                    continue
+
+                self._render_pending(pending_segments)
+                pending_segments = []
+                next_editor = command(self.editor)
+                if next_editor is not self.editor:
+                    self._adopt(next_editor)
+            except Exception as err:
+                print('line {}: {}'.format(command.line_number, err), file=error_stream)
+            if command.name == 'X':
+                break
+
+        self._render_pending(pending_segments)
+        return self.editor
+
+    def close(self):
+        """
+        Stops the worker processes and frees the shared memory. The editor keeps a private copy of the pixels
+        :return:
+        """
+        self._stop_workers()
+        if self._memory is not None:
+            self.editor._storage = BytearrayStorage(width=self.editor.width, height=self.editor.height,
+                                                    buffer=bytearray(self._shared_buffer))
+            self._release_memory()
+
+    def _verified_segments(self, footprint: tuple, color: str) -> list:
+        """
+        Verifies a footprint fits the matrix. Raises any necessary Exception
+        :param footprint: the segments a command paints
+        :param color: the color the command paints with
+        :return: the segments, with the color byte value
+        """
+        self.editor._verify_bounding_box(footprint)
+        value = self.editor._verify_color(color)
+        return [(direction, fixed, start, end, value) for direction, fixed, start, end in footprint]
+
+    def _render_pending(self, segments: list):
+        """
+        Paints queued segments, one task per tile
+        :param segments: the queued segments
+        :return:
+        """
+        if not segments:
+            return
+        for direction, fixed, start, end, _ in segments:
+            if direction == 'h':
+                self.editor._mark_rows_dirty(fixed, fixed)
+            else:
+                self.editor._mark_rows_dirty(start, end)
+
+        if self._workers == 1:
+            _render_segments(self.editor._storage, segments)
+            return
+        tiles = plan_tiles(segments, tile_width=self._tile_width, tile_height=self._tile_height)
+        if len(tiles) == 1:
+            _render_segments(self.editor._storage, segments)
+            return
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._workers, initializer=_attach_worker,
+                                             initargs=(self._memory.name, self.editor.width, self.editor.height))
+        for future in [self._pool.submit(_render_tile, tile_segments) for tile_segments in tiles.values()]:
+            future.result()
+
+    def _allocate(self, width: int, height: int):
+        """
+        Creates a blank shared matrix
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :return:
+        """
+        self._memory = shared_memory.SharedMemory(create=True, size=width * height)
+        self._shared_buffer = self._memory.buf[:width * height]
+        storage = BytearrayStorage(width=width, height=height, buffer=self._shared_buffer)
+        storage.clear()
+        self.editor = MatrixEditor(width=width, height=height, storage=storage)
+
+    def _adopt(self, editor: MatrixEditor):
+        """
+        Replaces the shared matrix with a copy of editor, e.g. after an I or O command.
+        A matrix of the same size is copied over the shared one, keeping the workers attached to it
+        :param editor: the matrix editor to copy
+        :return:
+        """
+        if (editor.width, editor.height) != (self.editor.width, self.editor.height):
+            self._stop_workers()
+            self._release_memory()
+            self._allocate(editor.width, editor.height)
+        else:
+            self.editor = MatrixEditor(width=editor.width, height=editor.height, storage=self.editor._storage)
+        for y, row in enumerate(editor._storage.iter_rows()):
+            self.editor._storage.put_row(y, row)
+
+    def _stop_workers(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _release_memory(self):
+        self._shared_buffer.release()
+        self._shared_buffer = None
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+
+def render_compiled(commands, workers: int = None, tile_size: int = DEFAULT_TILE_SIZE, error_stream=None):
+    """
+    Runs compiled commands on a tiled canvas, stopping at the first X command
+    :param commands: iterable of CompiledCommand, e.g. from compile_script. Must begin with an I or O command
+    :param workers: how many processes paint the tiles. Defaults to the number of CPUs
+    :param tile_size: the width and height of the tiles
+    :param error_stream: where to report failing commands, with their line numbers. Defaults to stderr
+    :return: the matrix editor as left by the commands, None if they never created one
+    """
+    if error_stream is None:
+        error_stream = sys.stderr
+
+    commands = iter(commands)
+    editor = None
+    for command in commands:
+        try:
+            editor = command(editor)
+        except Exception as err:
+            print('line {}: {}'.format(command.line_number, err), file=error_stream)
+        if command.name == 'X':
+            return None
+        if editor is not None:
+            break
+    else:
+        return None
+
+    with TiledCanvas(width=editor.width, height=editor.height, tile_width=tile_size, tile_height=tile_size,
+                     workers=workers) as canvas:
+        # the canvas starts blank, as an I command leaves it
+        if command.name != 'I':
+            canvas._adopt(editor)
+        return canvas.render(commands, error_stream=error_stream)
+
+
+def render_script(lines, workers: int = None, tile_size: int = DEFAULT_TILE_SIZE, error_stream=None):
+    """
+    Executes a command script on a tiled canvas, stopping at the first X command
+    :param lines: iterable of command lines, e.g. an open file or sys.stdin. Must begin with an I or O command
+    :param workers: how many processes paint the tiles. Defaults to the number of CPUs
+    :param tile_size: the width and height of the tiles
+    :param error_stream: where to report failing commands, with their line numbers. Defaults to stderr
+    :return: the matrix editor as left by the script, None if the script never created one
+    """
+    return render_compiled(compile_script(lines), workers=workers, tile_size=tile_size, error_stream=error_stream)
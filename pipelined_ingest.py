@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import locale
+import os
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from image_editor import COMMANDS, CompiledCommand, compile_line
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# how many chunks each worker may have parsed, or be parsing, ahead of the commands being run
+CHUNKS_AHEAD_PER_WORKER = 2
+
+# command letter -> how many of its arguments are integers. They all come before its string argument, if any
+_INT_ARG_COUNTS = {name: sum(arg_type is not str for arg_type in spec.arg_types) for name, spec in COMMANDS.items()}
+
+# command letter -> what its CompiledCommand is built from
+_COMMAND_LAYOUTS = {name: (spec.handler, spec.needs_editor, _INT_ARG_COUNTS[name],
+                           len(spec.arg_types) - _INT_ARG_COUNTS[name]) for name, spec in COMMANDS.items()}
+
+# the command letter of the lines left for compile_line, which reports why they fail to compile
+_UNPARSED = 0
+
+
+def read_chunks(file, chunk_size: int = DEFAULT_CHUNK_SIZE) -> iter:
+    """
+    Reads a file in chunks of whole lines
+    :param file: a file opened for binary reading
+    :param chunk_size: how many bytes to read at once. Chunks are longer when a line is
+    :return: generator of (line number of the first line, chunk bytes)
+    """
+    line_number = 1
+    unfinished_line = b''
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            if unfinished_line:
+                yield line_number, unfinished_line
+            return
+        data = unfinished_line + data
+        chunk_end = data.rfind(b'\n') + 1
+        chunk, unfinished_line = data[:chunk_end], data[chunk_end:]
+        if chunk:
+            yield line_number, chunk
+            line_number += chunk.count(b'\n')
+
+
+def parse_chunk(first_line_number: int, chunk: bytes, encoding: str) -> tuple:
+    """
+    Parses the command lines of a chunk into compact arrays, skipping the blank ones
+    :param first_line_number: the line number of the first line of the chunk
+    :param chunk: the lines, as read from the file
+    :param encoding: the encoding of the file
+    :return: (command letters, line numbers, integer arguments, string arguments) of the commands in the chunk.
+    The lines that fail to parse have the _UNPARSED letter and their split line as their only string argument
+    """
+    names = bytearray()
+    line_numbers = array('q')
+    int_args = array('q')
+    str_args = []
+    for line_number, line in enumerate(chunk.decode(encoding).split('\n'), start=first_line_number):
+        split_command = line.split()
+        if not split_command:
+            continue
+        line_numbers.append(line_number)
+        name = split_command[0][:1].upper()
+        spec = COMMANDS.get(name)
+        if spec is not None and len(split_command) - 1 == len(spec.arg_types):
+            int_arg_count = _INT_ARG_COUNTS[name]
+            try:
+                # fails as a whole on integers too big for the array
+                parsed_int_args = array('q', [arg_type(arg) for arg_type, arg
+                                              in zip(spec.arg_types[:int_arg_count], split_command[1:])])
+            except (ValueError, OverflowError):
+                pass
+            else:
+                names.append(ord(name))
+                int_args.extend(parsed_int_args)
+                str_args.extend(split_command[int_arg_count + 1:])
+                continue
+        names.append(_UNPARSED)
+        str_args.append(split_command)
+    return bytes(names), line_numbers, int_args, str_args
+
+
+def _compiled_commands(parsed_chunk: tuple) -> iter:
+    """
+    Turns a parsed chunk into the commands it holds
+    :param parsed_chunk: as parse_chunk returns it
+    :return: generator of CompiledCommand
+    """
+    names, line_numbers, int_args, str_args = parsed_chunk
+    int_args = int_args.tolist()
+    int_index = 0
+    str_index = 0
+    for name, line_number in zip(names.decode('latin-1'), line_numbers):
+        if name not in _COMMAND_LAYOUTS:
+            yield compile_line(str_args[str_index], line_number=line_number)
+            str_index += 1
+            continue
+        handler, needs_editor, int_arg_count, str_arg_count = _COMMAND_LAYOUTS[name]
+        args = tuple(int_args[int_index:int_index + int_arg_count])
+        int_index += int_arg_count
+        if str_arg_count:
+            args += (str_args[str_index], )
+            str_index += 1
+        yield CompiledCommand(name, handler, args, needs_editor, line_number)
+
+
+def ingest_script(file, workers: int = None, chunk_size: int = DEFAULT_CHUNK_SIZE, encoding: str = None) -> iter:
+    """
+    Compiles a command script as compile_script does, parsing it in worker processes while its earlier commands
+    run: the file is read in chunks of lines, each parsed by a worker, and the chunks are compiled in order as the
+    commands are consumed. Only a few chunks per worker are read ahead, so memory stays bounded on any file size
+    :param file: the command script, opened for binary reading
+    :param workers: how many processes parse the chunks. Defaults to the number of CPUs
+    :param chunk_size: how many bytes of lines each worker parses at once
+    :param encoding: the encoding of the file. Defaults to the one open() uses
+    :return: generator of CompiledCommand
+    """
+    if chunk_size <= 0:
+        raise ValueError('Chunk size must be a positive integer. Received: {}'.format(chunk_size))
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    chunks = read_chunks(file, chunk_size=chunk_size)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        parsed_chunks = deque()
+        for _ in range(workers * CHUNKS_AHEAD_PER_WORKER):
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            parsed_chunks.append(executor.submit(parse_chunk, *chunk, encoding))
+
+        while parsed_chunks:
+            parsed_chunk = parsed_chunks.popleft().result()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                parsed_chunks.append(executor.submit(parse_chunk, *chunk, encoding))
+            yield from _compiled_commands(parsed_chunk)
+    finally:
+        # the script may be left unfinished, e.g. by an X command
+        executor.shutdown(cancel_futures=True)
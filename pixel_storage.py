@@ -0,0 +1,875 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import re
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BACKGROUND = ord('0')
+
+# half the width and height of the window the first labelling of a numpy fill looks at
+FILL_WINDOW_HALF_SIZE = 32
+
+_RUN_PATTERNS = {}
+
+# matches each run of same valued bytes
+_ANY_RUN_PATTERN = re.compile(b'(.)\\1*', re.DOTALL)
+
+
+def _run_pattern(value: int):
+    """
+    Compiles (once per value) the pattern matching a run of the byte value
+    :param value: the byte value of the run
+    :return: the compiled pattern
+    """
+    pattern = _RUN_PATTERNS.get(value)
+    if pattern is None:
+        pattern = _RUN_PATTERNS[value] = re.compile(re.escape(bytes((value, ))) + b'+')
+    return pattern
+
+
+def _find_runs(buffer, row_start: int, row_end: int, x1: int, x2: int, value: int) -> list:
+    """
+    Finds the maximal runs of value in a row of buffer that have at least one pixel within x1..x2
+    :param buffer: the buffer holding the row
+    :param row_start: the offset where the row starts
+    :param row_end: the offset where the row ends
+    :param x1: the left-most X of the search window
+    :param x2: the right-most X of the search window
+    :param value: the byte value of the runs
+    :return: list of (start, end) inclusive X ranges, left to right
+    """
+    window_start = row_start + x1
+    window_end = row_start + x2 + 1
+    pattern = _run_pattern(value)
+
+    runs = [[match.start(), match.end()] for match in pattern.finditer(buffer, window_start, window_end)]
+    if not runs:
+        return runs
+
+    if runs[0][0] == window_start and window_start > row_start:
+        runs[0][0] = _run_left_edge(buffer, value, row_start, window_start)
+    if runs[-1][1] == window_end and window_end < row_end:
+        match = pattern.match(buffer, window_end, row_end)
+        if match is not None:
+            runs[-1][1] = match.end()
+
+    return [(start - row_start, end - row_start - 1) for start, end in runs]
+
+
+def _run_left_edge(buffer, value: int, row_start: int, position: int) -> int:
+    """
+    Walks left from position, in growing chunks, to the first offset of the run of value ending there
+    :param buffer: the buffer holding the row
+    :param value: the byte value of the run
+    :param row_start: the offset where the row starts
+    :param position: the offset right after a pixel known to hold value
+    :return: the offset of the left-most pixel of the run
+    """
+    chunk = 64
+    run_byte = bytes((value, ))
+    while position > row_start:
+        chunk_start = max(position - chunk, row_start)
+        kept = len(bytes(buffer[chunk_start:position]).rstrip(run_byte))
+        if kept:
+            return chunk_start + kept
+        position = chunk_start
+        chunk *= 2
+    return row_start
+
+
+class BytearrayStorage(object):
+    """
+    Stores the pixels of a matrix in a flat, row-major byte buffer (a bytearray unless given), one byte per pixel
+    """
+    def __init__(self, width: int, height: int, buffer=None, stride: int = None):
+        """
+        Allocates width * height pixels, all of them set to the background color,
+        or wraps an existing writable buffer (e.g. an mmap) without copying it
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :param buffer: writable buffer already holding the pixels, row-major
+        :param stride: bytes from the start of a row to the start of the next one. Defaults to width,
+        a wider stride leaves bytes between rows (e.g. new lines) untouched
+        """
+        self._width = width
+        self._height = height
+        self._stride = width if stride is None else stride
+        if buffer is None:
+            buffer = bytearray(b'0') * (self._stride * height)
+        elif len(buffer) < self._stride * (height - 1) + width:
+            raise ValueError('Buffer is too small for a {}x{} matrix'.format(width, height))
+        self._buffer = buffer
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    def offset(self, x: int, y: int) -> int:
+        """
+        Maps the coordinate (x, y) to its position in the buffer
+        :param x: the X coordinate of the pixel
+        :param y: the Y coordinate of the pixel
+        :return: the buffer offset of the pixel
+        """
+        return y * self._stride + x
+
+    def get(self, x: int, y: int) -> int:
+        return self._buffer[y * self._stride + x]
+
+    def set(self, x: int, y: int, value: int):
+        self._buffer[y * self._stride + x] = value
+
+    def get_row(self, y: int) -> bytes:
+        start = y * self._stride
+        return bytes(self._buffer[start:start + self._width])
+
+    def iter_rows(self, start: int = 0, stop: int = None) -> iter:
+        """
+        Iterates over the rows without copying them
+        :param start: the first row to iterate over
+        :param stop: the row to stop before. Defaults to the matrix height
+        :return: generator of one memoryview per row, top to bottom
+        """
+        if stop is None:
+            stop = self._height
+        buffer = memoryview(self._buffer)
+        for row_start in range(start * self._stride, stop * self._stride, self._stride):
+            yield buffer[row_start:row_start + self._width]
+
+    def put_row(self, y: int, data: bytes):
+        """
+        Overwrites the whole row y with data
+        :param y: the row to overwrite
+        :param data: exactly width bytes
+        :return:
+        """
+        if len(data) != self._width:
+            raise ValueError('Row must have exactly {} pixels. Received: {}'.format(self._width, len(data)))
+        start = y * self._stride
+        self._buffer[start:start + self._width] = data
+
+    def get_span(self, y: int, x1: int, x2: int) -> bytes:
+        start = y * self._stride
+        return bytes(self._buffer[start + x1:start + x2 + 1])
+
+    def put_span(self, y: int, x1: int, data: bytes):
+        start = y * self._stride + x1
+        self._buffer[start:start + len(data)] = data
+
+    def get_column(self, x: int, y1: int, y2: int) -> bytes:
+        return bytes(self._buffer[y1 * self._stride + x:y2 * self._stride + x + 1:self._stride])
+
+    def put_column(self, x: int, y1: int, data: bytes):
+        start = y1 * self._stride + x
+        self._buffer[start:start + (len(data) - 1) * self._stride + 1:self._stride] = data
+
+    def fill_span(self, y: int, x1: int, x2: int, value: int):
+        """
+        Sets the pixels x1..x2 (inclusive) of row y to value in a single write
+        :param y: the row of the span
+        :param x1: the left-most X of the span
+        :param x2: the right-most X of the span
+        :param value: the byte value to write
+        :return:
+        """
+        start = y * self._stride
+        self._buffer[start + x1:start + x2 + 1] = bytes((value, )) * (x2 - x1 + 1)
+
+    def fill_column(self, x: int, y1: int, y2: int, value: int):
+        """
+        Sets the pixels y1..y2 (inclusive) of column x to value in a single strided write
+        :param x: the column of the span
+        :param y1: the upper-most Y of the span
+        :param y2: the lower-most Y of the span
+        :param value: the byte value to write
+        :return:
+        """
+        start = y1 * self._stride + x
+        self._buffer[start:y2 * self._stride + x + 1:self._stride] = bytes((value, )) * (y2 - y1 + 1)
+
+    def find_runs(self, y: int, x1: int, x2: int, value: int) -> list:
+        """
+        Finds the maximal runs of value in row y that have at least one pixel within x1..x2
+        :param y: the row to search
+        :param x1: the left-most X of the search window
+        :param x2: the right-most X of the search window
+        :param value: the byte value of the runs
+        :return: list of (start, end) inclusive X ranges, left to right
+        """
+        row_start = y * self._stride
+        return _find_runs(self._buffer, row_start, row_start + self._width, x1, x2, value)
+
+    def clear(self):
+        """
+        Resets every pixel to the background color, in a single buffer write unless rows are strided
+        :return:
+        """
+        if self._stride == self._width:
+            self._buffer[:self._width * self._height] = b'0' * (self._width * self._height)
+            return
+        blank_row = b'0' * self._width
+        for start in range(0, self._height * self._stride, self._stride):
+            self._buffer[start:start + self._width] = blank_row
+
+
+class RowStorage(object):
+    """
+    Stores each row of a matrix in its own buffer, so forks of the matrix can share the rows neither of them
+    changed. A row is copied on the first write to it, unless the store owns it already.
+    Rows never written to share a single blank row, so they take no memory of their own either
+    """
+    def __init__(self, width: int, height: int, rows: list = None):
+        """
+        Allocates width * height pixels, all of them set to the background color, or adopts existing rows
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :param rows: height buffers of width pixels each, shared with whoever else holds them until written to
+        """
+        self._width = width
+        self._height = height
+        self._blank_row = bytes((BACKGROUND, )) * width
+        if rows is None:
+            rows = [self._blank_row] * height
+        elif len(rows) != height:
+            raise ValueError('Matrix must have exactly {} rows. Received: {}'.format(height, len(rows)))
+        self._rows = rows
+        # one flag per row this store may write to in place
+        self._owned_rows = bytearray(height)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    def fork(self) -> 'RowStorage':
+        """
+        Copies the store in O(height), sharing every row with the copy until either of them writes to it
+        :return: the copy
+        """
+        self._owned_rows = bytearray(self._height)
+        return RowStorage(width=self._width, height=self._height, rows=list(self._rows))
+
+    def get(self, x: int, y: int) -> int:
+        return self._rows[y][x]
+
+    def set(self, x: int, y: int, value: int):
+        self._writable_row(y)[x] = value
+
+    def get_row(self, y: int) -> bytes:
+        return bytes(self._rows[y])
+
+    def iter_rows(self, start: int = 0, stop: int = None) -> iter:
+        """
+        Iterates over the rows without copying them
+        :param start: the first row to iterate over
+        :param stop: the row to stop before. Defaults to the matrix height
+        :return: generator of one buffer per row, top to bottom
+        """
+        return iter(self._rows[start:stop])
+
+    def put_row(self, y: int, data: bytes):
+        if len(data) != self._width:
+            raise ValueError('Row must have exactly {} pixels. Received: {}'.format(self._width, len(data)))
+        self._rows[y] = bytearray(data)
+        self._owned_rows[y] = 1
+
+    def get_span(self, y: int, x1: int, x2: int) -> bytes:
+        return bytes(self._rows[y][x1:x2 + 1])
+
+    def put_span(self, y: int, x1: int, data: bytes):
+        self._writable_row(y)[x1:x1 + len(data)] = data
+
+    def get_column(self, x: int, y1: int, y2: int) -> bytes:
+        return bytes(row[x] for row in self._rows[y1:y2 + 1])
+
+    def put_column(self, x: int, y1: int, data: bytes):
+        for y, value in enumerate(data, start=y1):
+            self._writable_row(y)[x] = value
+
+    def fill_span(self, y: int, x1: int, x2: int, value: int):
+        self._writable_row(y)[x1:x2 + 1] = bytes((value, )) * (x2 - x1 + 1)
+
+    def fill_column(self, x: int, y1: int, y2: int, value: int):
+        for y in range(y1, y2 + 1):
+            self._writable_row(y)[x] = value
+
+    def find_runs(self, y: int, x1: int, x2: int, value: int) -> list:
+        """
+        Finds the maximal runs of value in row y that have at least one pixel within x1..x2
+        :param y: the row to search
+        :param x1: the left-most X of the search window
+        :param x2: the right-most X of the search window
+        :param value: the byte value of the runs
+        :return: list of (start, end) inclusive X ranges, left to right
+        """
+        return _find_runs(self._rows[y], 0, self._width, x1, x2, value)
+
+    def clear(self):
+        """
+        Points every row back to the shared blank row
+        :return:
+        """
+        self._rows = [self._blank_row] * self._height
+        self._owned_rows = bytearray(self._height)
+
+    def _writable_row(self, y: int) -> bytearray:
+        """
+        Gets row y to write to, copying it first unless the store owns it
+        :param y: the row to write to
+        :return: the row
+        """
+        if not self._owned_rows[y]:
+            self._rows[y] = bytearray(self._rows[y])
+            self._owned_rows[y] = 1
+        return self._rows[y]
+
+
+class LazyStorage(object):
+    """
+    Stores only the rows written to since the matrix was last cleared, so creating and clearing even huge
+    matrices takes no time. Each row written to is stamped with the generation it was written in, and clearing
+    the matrix starts a new generation: rows of older generations read as blank rows, and are blanked again,
+    in place, on the next write to them
+    """
+    def __init__(self, width: int, height: int, rows: dict = None):
+        """
+        Allocates no pixels, all of them reading as the background color, or adopts existing rows
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :param rows: row -> buffer of width pixels of the rows written to, shared with whoever else holds them
+        until written to
+        """
+        self._width = width
+        self._height = height
+        self._blank_row = bytes((BACKGROUND, )) * width
+        self._generation = 0
+        # row -> (generation it was written in, its pixels)
+        self._rows = {y: (0, row) for y, row in rows.items()} if rows is not None else {}
+        # rows shared with a fork, copied on the next write to them
+        self._shared_rows = set(self._rows)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    def fork(self) -> 'LazyStorage':
+        """
+        Copies the store in O(rows written to), sharing them with the copy until either of them writes to them
+        :return: the copy
+        """
+        rows = {y: row for y, (generation, row) in self._rows.items() if generation == self._generation}
+        self._shared_rows.update(rows)
+        return LazyStorage(width=self._width, height=self._height, rows=rows)
+
+    def get(self, x: int, y: int) -> int:
+        return self._row(y)[x]
+
+    def set(self, x: int, y: int, value: int):
+        self._writable_row(y)[x] = value
+
+    def get_row(self, y: int) -> bytes:
+        return bytes(self._row(y))
+
+    def iter_rows(self, start: int = 0, stop: int = None) -> iter:
+        """
+        Iterates over the rows without copying them. Rows not written to are all the same blank row
+        :param start: the first row to iterate over
+        :param stop: the row to stop before. Defaults to the matrix height
+        :return: generator of one buffer per row, top to bottom
+        """
+        for y in range(start, self._height if stop is None else stop):
+            yield self._row(y)
+
+    def put_row(self, y: int, data: bytes):
+        if len(data) != self._width:
+            raise ValueError('Row must have exactly {} pixels. Received: {}'.format(self._width, len(data)))
+        self._rows[y] = (self._generation, bytearray(data))
+        self._shared_rows.discard(y)
+
+    def get_span(self, y: int, x1: int, x2: int) -> bytes:
+        return bytes(self._row(y)[x1:x2 + 1])
+
+    def put_span(self, y: int, x1: int, data: bytes):
+        self._writable_row(y)[x1:x1 + len(data)] = data
+
+    def get_column(self, x: int, y1: int, y2: int) -> bytes:
+        return bytes(self._row(y)[x] for y in range(y1, y2 + 1))
+
+    def put_column(self, x: int, y1: int, data: bytes):
+        for y, value in enumerate(data, start=y1):
+            self._writable_row(y)[x] = value
+
+    def fill_span(self, y: int, x1: int, x2: int, value: int):
+        self._writable_row(y)[x1:x2 + 1] = bytes((value, )) * (x2 - x1 + 1)
+
+    def fill_column(self, x: int, y1: int, y2: int, value: int):
+        for y in range(y1, y2 + 1):
+            self._writable_row(y)[x] = value
+
+    def find_runs(self, y: int, x1: int, x2: int, value: int) -> list:
+        """
+        Finds the maximal runs of value in row y that have at least one pixel within x1..x2
+        :param y: the row to search
+        :param x1: the left-most X of the search window
+        :param x2: the right-most X of the search window
+        :param value: the byte value of the runs
+        :return: list of (start, end) inclusive X ranges, left to right
+        """
+        return _find_runs(self._row(y), 0, self._width, x1, x2, value)
+
+    def clear(self):
+        """
+        Starts a new generation, so every row reads as blank again. The rows keep their buffers for later writes
+        :return:
+        """
+        self._generation += 1
+
+    def swap_generation(self, held: tuple = None) -> tuple:
+        """
+        Clears the matrix as clear does, but hands its rows over instead of keeping them to be blanked on the next
+        write, so they can be put back later. Given what an earlier call handed over, puts that back instead
+        :param held: what an earlier call returned, to put back
+        :return: what the matrix held before this call
+        """
+        previously_held = (self._generation, self._rows, self._shared_rows)
+        if held is None:
+            self._generation += 1
+            self._rows = {}
+            self._shared_rows = set()
+        else:
+            self._generation, self._rows, self._shared_rows = held
+        return previously_held
+
+    def _row(self, y: int):
+        """
+        Gets row y to read from
+        :param y: the row to read
+        :return: the row, or the shared blank row if it was not written to since the matrix was last cleared
+        """
+        generation, row = self._rows.get(y, (None, None))
+        return row if generation == self._generation else self._blank_row
+
+    def _writable_row(self, y: int) -> bytearray:
+        """
+        Gets row y to write to, materializing it on the first write since the matrix was last cleared,
+        and copying it first if it is shared with a fork
+        :param y: the row to write to
+        :return: the row
+        """
+        generation, row = self._rows.get(y, (None, None))
+        if generation == self._generation:
+            if y in self._shared_rows:
+                row = bytearray(row)
+                self._rows[y] = (generation, row)
+                self._shared_rows.discard(y)
+        elif row is None or y in self._shared_rows:
+            row = bytearray(self._blank_row)
+            self._rows[y] = (self._generation, row)
+            self._shared_rows.discard(y)
+        else:
+            row[:] = self._blank_row
+            self._rows[y] = (self._generation, row)
+        return row
+
+
+class NumpyStorage(object):
+    """
+    Stores the pixels of a matrix in a height x width numpy uint8 array, painting with vectorized operations
+    """
+    def __init__(self, width: int, height: int):
+        """
+        Allocates width * height pixels, all of them set to the background color
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        """
+        if numpy is None:
+            raise ImportError('The numpy storage backend requires numpy')
+        self._width = width
+        self._height = height
+        self._pixels = numpy.full((height, width), BACKGROUND, dtype=numpy.uint8)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def buffer(self):
+        return self._pixels
+
+    def get(self, x: int, y: int) -> int:
+        return int(self._pixels[y, x])
+
+    def set(self, x: int, y: int, value: int):
+        self._pixels[y, x] = value
+
+    def get_row(self, y: int) -> bytes:
+        return self._pixels[y].tobytes()
+
+    def iter_rows(self, start: int = 0, stop: int = None) -> iter:
+        """
+        Iterates over the rows without copying them
+        :param start: the first row to iterate over
+        :param stop: the row to stop before. Defaults to the matrix height
+        :return: generator of one memoryview per row, top to bottom
+        """
+        for row in self._pixels[start:stop]:
+            yield memoryview(row)
+
+    def put_row(self, y: int, data: bytes):
+        if len(data) != self._width:
+            raise ValueError('Row must have exactly {} pixels. Received: {}'.format(self._width, len(data)))
+        self._pixels[y] = numpy.frombuffer(data, dtype=numpy.uint8)
+
+    def get_span(self, y: int, x1: int, x2: int) -> bytes:
+        return self._pixels[y, x1:x2 + 1].tobytes()
+
+    def put_span(self, y: int, x1: int, data: bytes):
+        self._pixels[y, x1:x1 + len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+
+    def get_column(self, x: int, y1: int, y2: int) -> bytes:
+        return self._pixels[y1:y2 + 1, x].tobytes()
+
+    def put_column(self, x: int, y1: int, data: bytes):
+        self._pixels[y1:y1 + len(data), x] = numpy.frombuffer(data, dtype=numpy.uint8)
+
+    def fill_span(self, y: int, x1: int, x2: int, value: int):
+        self._pixels[y, x1:x2 + 1] = value
+
+    def fill_column(self, x: int, y1: int, y2: int, value: int):
+        self._pixels[y1:y2 + 1, x] = value
+
+    def find_runs(self, y: int, x1: int, x2: int, value: int) -> list:
+        """
+        Finds the maximal runs of value in row y that have at least one pixel within x1..x2
+        :param y: the row to search
+        :param x1: the left-most X of the search window
+        :param x2: the right-most X of the search window
+        :param value: the byte value of the runs
+        :return: list of (start, end) inclusive X ranges, left to right
+        """
+        starts, ends = _mask_runs(self._pixels[y] == value)
+        overlapping = (ends >= x1) & (starts <= x2)
+        return list(zip(starts[overlapping].tolist(), ends[overlapping].tolist()))
+
+    def fill_region(self, x: int, y: int, value: int, connectivity: int) -> array:
+        """
+        Paints the region of same colored pixels around (x, y) with value.
+        The region is labelled within a window around (x, y), doubled until the region doesn't reach its sides,
+        so small regions cost little and the largest ones at most about twice a labelling of the whole matrix
+        :param x: the X coordinate of a pixel of the region
+        :param y: the Y coordinate of a pixel of the region
+        :param value: the byte value to paint with
+        :param connectivity: 8 to grow the region diagonally as well, 4 to grow it only across edges
+        :return: the painted spans, as a flat array of y, x1, x2 triples
+        """
+        reach = 1 if connectivity == 8 else 0
+        target = self._pixels[y, x]
+        half_size = FILL_WINDOW_HALF_SIZE
+        while True:
+            top, bottom = max(y - half_size, 0), min(y + half_size + 1, self._height)
+            left, right = max(x - half_size, 0), min(x + half_size + 1, self._width)
+            window = self._pixels[top:bottom, left:right]
+            rows, starts, ends = _region_runs(window == target, y - top, x - left, reach)
+            # the region may go on out of the window only through a side of it within the matrix
+            if (top == 0 or rows[0] > 0) and (bottom == self._height or rows[-1] < bottom - top - 1) and \
+                    (left == 0 or starts.min() > 0) and (right == self._width or ends.max() < right - left - 1):
+                break
+            half_size *= 2
+
+        window_width = right - left
+        changes = numpy.zeros(window.size + 1, dtype=numpy.int8)
+        changes[rows * window_width + starts] += 1
+        changes[rows * window_width + ends + 1] -= 1
+        window[numpy.cumsum(changes[:-1], dtype=numpy.int8).reshape(window.shape).view(bool)] = value
+
+        spans = array('l')
+        spans.frombytes(numpy.column_stack((rows + top, starts + left, ends + left)).astype('l').tobytes())
+        return spans
+
+    def clear(self):
+        self._pixels.fill(BACKGROUND)
+
+
+class RleStorage(object):
+    """
+    Stores each row of a matrix as runs of same colored pixels, so its memory and the time to paint
+    spans, find runs and clear it grow with how many runs the matrix has rather than with how many pixels.
+    Runs are kept maximal: no two runs side by side have the same value
+    """
+    def __init__(self, width: int, height: int, runs: tuple = None):
+        """
+        Allocates width * height pixels, all of them set to the background color, or adopts existing runs
+        :param width: positive integer for matrix width
+        :param height: positive integer for matrix height
+        :param runs: (run ends, run values) lists of the rows, shared with whoever else holds them until written to
+        """
+        self._width = width
+        self._height = height
+        if runs is None:
+            self.clear()
+        else:
+            # for each row, where each run ends (exclusive), left to right, and the value of each run
+            self._run_ends, self._run_values = runs
+            # one flag per row this store may change in place
+            self._owned_rows = bytearray(height)
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def run_count(self) -> int:
+        return sum(len(row_values) for row_values in self._run_values)
+
+    def fork(self) -> 'RleStorage':
+        """
+        Copies the store in O(height), sharing the runs of every row with the copy until either of them changes them
+        :return: the copy
+        """
+        self._owned_rows = bytearray(self._height)
+        return RleStorage(width=self._width, height=self._height,
+                          runs=(list(self._run_ends), list(self._run_values)))
+
+    def get(self, x: int, y: int) -> int:
+        return self._run_values[y][bisect_right(self._run_ends[y], x)]
+
+    def set(self, x: int, y: int, value: int):
+        self.fill_span(y, x, x, value)
+
+    def get_row(self, y: int) -> bytes:
+        return self._expand(y, 0, self._width - 1)
+
+    def iter_rows(self, start: int = 0, stop: int = None) -> iter:
+        """
+        Iterates over the rows, expanding the runs of one row at a time
+        :param start: the first row to iterate over
+        :param stop: the row to stop before. Defaults to the matrix height
+        :return: generator of one bytes per row, top to bottom
+        """
+        if stop is None:
+            stop = self._height
+        for y in range(start, stop):
+            yield self._expand(y, 0, self._width - 1)
+
+    def put_row(self, y: int, data: bytes):
+        """
+        Overwrites the whole row y with data
+        :param y: the row to overwrite
+        :param data: exactly width bytes
+        :return:
+        """
+        if len(data) != self._width:
+            raise ValueError('Row must have exactly {} pixels. Received: {}'.format(self._width, len(data)))
+        row_ends = array('l')
+        row_values = bytearray()
+        for match in _ANY_RUN_PATTERN.finditer(data):
+            row_ends.append(match.end())
+            row_values.append(data[match.start()])
+        self._run_ends[y] = row_ends
+        self._run_values[y] = row_values
+        self._owned_rows[y] = 1
+
+    def get_span(self, y: int, x1: int, x2: int) -> bytes:
+        return self._expand(y, x1, x2)
+
+    def put_span(self, y: int, x1: int, data: bytes):
+        for match in _ANY_RUN_PATTERN.finditer(data):
+            self.fill_span(y, x1 + match.start(), x1 + match.end() - 1, data[match.start()])
+
+    def get_column(self, x: int, y1: int, y2: int) -> bytes:
+        return bytes(self.get(x, y) for y in range(y1, y2 + 1))
+
+    def put_column(self, x: int, y1: int, data: bytes):
+        for y, value in enumerate(data, start=y1):
+            self.fill_span(y, x, x, value)
+
+    def fill_span(self, y: int, x1: int, x2: int, value: int):
+        """
+        Replaces the runs covering x1..x2 (inclusive) of row y with a single run of value,
+        merged with the runs of value right before and after it
+        :param y: the row of the span
+        :param x1: the left-most X of the span
+        :param x2: the right-most X of the span
+        :param value: the byte value to write
+        :return:
+        """
+        if not self._owned_rows[y]:
+            self._run_ends[y] = array('l', self._run_ends[y])
+            self._run_values[y] = bytearray(self._run_values[y])
+            self._owned_rows[y] = 1
+        row_ends = self._run_ends[y]
+        row_values = self._run_values[y]
+        first = bisect_right(row_ends, x1)
+        last = bisect_right(row_ends, x2)
+        new_ends = array('l')
+        new_values = bytearray()
+
+        # the part of the first run left of the span stays, unless it has value already
+        if row_values[first] != value:
+            if (row_ends[first - 1] if first else 0) < x1:
+                new_ends.append(x1)
+                new_values.append(row_values[first])
+            elif first and row_values[first - 1] == value:
+                first -= 1
+
+        # and so does the part of the last run right of the span
+        span_end = x2 + 1
+        right_end = None
+        if row_values[last] == value:
+            span_end = row_ends[last]
+        elif row_ends[last] > span_end:
+            right_end = row_ends[last]
+        elif last + 1 < len(row_ends) and row_values[last + 1] == value:
+            last += 1
+            span_end = row_ends[last]
+
+        new_ends.append(span_end)
+        new_values.append(value)
+        if right_end is not None:
+            new_ends.append(right_end)
+            new_values.append(row_values[last])
+        row_ends[first:last + 1] = new_ends
+        row_values[first:last + 1] = new_values
+
+    def fill_column(self, x: int, y1: int, y2: int, value: int):
+        for y in range(y1, y2 + 1):
+            self.fill_span(y, x, x, value)
+
+    def find_runs(self, y: int, x1: int, x2: int, value: int) -> list:
+        """
+        Finds the maximal runs of value in row y that have at least one pixel within x1..x2
+        :param y: the row to search
+        :param x1: the left-most X of the search window
+        :param x2: the right-most X of the search window
+        :param value: the byte value of the runs
+        :return: list of (start, end) inclusive X ranges, left to right
+        """
+        row_ends = self._run_ends[y]
+        row_values = self._run_values[y]
+        return [(row_ends[index - 1] if index else 0, row_ends[index] - 1)
+                for index in range(bisect_right(row_ends, x1), bisect_right(row_ends, x2) + 1)
+                if row_values[index] == value]
+
+    def clear(self):
+        """
+        Resets every row to a single run of the background color
+        :return:
+        """
+        self._run_ends = [array('l', (self._width, )) for _ in range(self._height)]
+        self._run_values = [bytearray((BACKGROUND, )) for _ in range(self._height)]
+        self._owned_rows = bytearray(b'\x01') * self._height
+
+    def _expand(self, y: int, x1: int, x2: int) -> bytes:
+        """
+        Expands the runs of row y into the pixels x1..x2 (inclusive)
+        :param y: the row to expand
+        :param x1: the left-most X to expand
+        :param x2: the right-most X to expand
+        :return: the pixels
+        """
+        row_ends = self._run_ends[y]
+        row_values = self._run_values[y]
+        index = bisect_right(row_ends, x1)
+        position = x1
+        pieces = []
+        while position <= x2:
+            run_end = min(row_ends[index], x2 + 1)
+            pieces.append(row_values[index:index + 1] * (run_end - position))
+            position = run_end
+            index += 1
+        return b''.join(pieces)
+
+
+def _region_runs(mask, y: int, x: int, reach: int) -> tuple:
+    """
+    Labels the runs of True of a boolean matrix in one pass: runs overlapping across consecutive rows are
+    joined, all the joins at once, until each group of joined runs is a connected region
+    :param mask: the boolean numpy matrix
+    :param y: the Y coordinate of a True pixel of the region to find
+    :param x: the X coordinate of that pixel
+    :param reach: 1 to join runs touching diagonally as well, 0 to join only those touching across edges
+    :return: (rows, starts, ends) numpy arrays of the runs of the region, row by row, as inclusive X ranges
+    """
+    height, width = mask.shape
+    # a False pixel on both sides of every row, so runs never span rows and a row of runs is stride wide
+    stride = width + 2
+    padded = numpy.zeros((height, stride), dtype=bool)
+    padded[:, 1:-1] = mask
+    flat = padded.ravel()
+    edges = numpy.flatnonzero(flat[1:] != flat[:-1])
+    starts = edges[0::2] + 1
+    ends = edges[1::2]
+
+    # the runs of the row above each run that it touches are a contiguous range of the runs
+    first_touched = numpy.searchsorted(ends, starts - stride - reach, side='left')
+    touched_counts = numpy.searchsorted(starts, ends - stride + reach, side='right') - first_touched
+    lower_runs = numpy.repeat(numpy.arange(len(starts)), touched_counts)
+    upper_runs = numpy.repeat(first_touched - numpy.cumsum(touched_counts) + touched_counts, touched_counts) + \
+        numpy.arange(len(lower_runs))
+
+    # every run points to the lowest run of its region once no join is left between runs of different roots
+    parents = numpy.arange(len(starts))
+    while len(lower_runs):
+        lower_roots = parents[lower_runs]
+        upper_roots = parents[upper_runs]
+        unjoined = lower_roots != upper_roots
+        lower_runs, upper_runs = lower_runs[unjoined], upper_runs[unjoined]
+        lower_roots, upper_roots = lower_roots[unjoined], upper_roots[unjoined]
+        numpy.minimum.at(parents, numpy.maximum(lower_roots, upper_roots), numpy.minimum(lower_roots, upper_roots))
+        while True:
+            grandparents = parents[parents]
+            if numpy.array_equal(grandparents, parents):
+                break
+            parents = grandparents
+
+    seed_run = numpy.searchsorted(starts, y * stride + x + 1, side='right') - 1
+    region = parents == parents[seed_run]
+    starts, ends = starts[region], ends[region]
+    return starts // stride, starts % stride - 1, ends % stride - 1
+
+
+def _mask_runs(mask) -> tuple:
+    """
+    Finds the runs of True in a boolean row
+    :param mask: the boolean numpy row
+    :return: (starts, ends) numpy arrays of the inclusive X ranges of the runs
+    """
+    edges = numpy.diff(mask.astype(numpy.int8), prepend=0, append=0)
+    return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1) - 1
+
+
+STORAGE_BACKENDS = {
+    'bytearray': BytearrayStorage,
+    'rows': RowStorage,
+    'lazy': LazyStorage,
+    'numpy': NumpyStorage,
+    'rle': RleStorage,
+}
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+from bisect import bisect_right
+
+DEFAULT_MAX_COMPONENTS = 256
+
+
+class Component(object):
+    """
+    A region painted by a fill: whole same colored connected component of the matrix, as long as it is indexed
+    """
+    __slots__ = ('connectivity', 'value', 'spans', 'rows', 'top', 'bottom', 'left', 'right', 'boundary_colors')
+
+    def __init__(self, connectivity: int, value: int, spans, rows: dict, boundary_colors: frozenset):
+        """
+        :param connectivity: the connectivity the component was filled with
+        :param value: the color of the component pixels
+        :param spans: the component spans, as a flat array of y, x1, x2 triples
+        :param rows: row -> sorted list of the (x1, x2) spans of the component in that row
+        :param boundary_colors: the colors of the pixels around the component
+        """
+        self.connectivity = connectivity
+        self.value = value
+        self.spans = spans
+        self.rows = rows
+        self.top = min(rows)
+        self.bottom = max(rows)
+        self.left = min(row[0][0] for row in rows.values())
+        self.right = max(row[-1][1] for row in rows.values())
+        self.boundary_colors = boundary_colors
+
+    def contains(self, x: int, y: int) -> bool:
+        row = self.rows.get(y)
+        if row is None:
+            return False
+        index = bisect_right(row, (x, float('inf'))) - 1
+        return index >= 0 and row[index][1] >= x
+
+    def touches(self, y: int, x1: int, x2: int) -> bool:
+        """
+        Checks if a span overlaps the component or the pixels around it
+        :param y: the row of the span
+        :param x1: the left-most X of the span
+        :param x2: the right-most X of the span
+        :return:
+        """
+        if y < self.top - 1 or y > self.bottom + 1 or x2 < self.left - 1 or x1 > self.right + 1:
+            return False
+        for row_y in (y - 1, y, y + 1):
+            row = self.rows.get(row_y)
+            if row is None:
+                continue
+            index = bisect_right(row, (x2 + 1, float('inf'))) - 1
+            if index >= 0 and row[index][1] >= x1 - 1:
+                return True
+        return False
+
+
+def _span_rows(spans) -> dict:
+    """
+    Groups spans by row
+    :param spans: flat array of y, x1, x2 triples
+    :return: row -> sorted list of the (x1, x2) spans in that row
+    """
+    rows = {}
+    for span_index in range(0, len(spans), 3):
+        rows.setdefault(spans[span_index], []).append((spans[span_index + 1], spans[span_index + 2]))
+    for row in rows.values():
+        row.sort()
+    return rows
+
+
+def _merge_intervals(intervals: list) -> list:
+    """
+    Merges overlapping and touching inclusive intervals
+    :param intervals: list of (start, end)
+    :return: sorted list of disjoint (start, end)
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _subtract_intervals(intervals: list, removed: list) -> list:
+    """
+    Removes intervals from others
+    :param intervals: sorted list of disjoint inclusive (start, end)
+    :param removed: sorted list of disjoint inclusive (start, end) to remove
+    :return: the parts of intervals out of removed
+    """
+    gaps = []
+    index = 0
+    for start, end in intervals:
+        while index < len(removed) and removed[index][1] < start:
+            index += 1
+        position = start
+        scan = index
+        while scan < len(removed) and removed[scan][0] <= end:
+            if removed[scan][0] > position:
+                gaps.append((position, removed[scan][0] - 1))
+            position = max(position, removed[scan][1] + 1)
+            scan += 1
+        if position <= end:
+            gaps.append((position, end))
+    return gaps
+
+
+class RegionIndex(object):
+    """
+    Remembers the regions painted by fills, so a fill of a known region only repaints its spans instead of
+    searching for it again. A region is only remembered while it is a whole component of its color:
+    any write within it or on the pixels around it forgets it
+    """
+    def __init__(self, max_components: int = DEFAULT_MAX_COMPONENTS):
+        """
+        :param max_components: how many components to remember. The oldest ones are forgotten past it
+        """
+        if max_components <= 0:
+            raise ValueError('Max components must be a positive integer. Received: {}'.format(max_components))
+        self._max_components = max_components
+        self._components = []
+
+    def __len__(self):
+        return len(self._components)
+
+    def find(self, x: int, y: int, connectivity: int) -> Component:
+        """
+        Finds the component holding a pixel
+        :param x: the X coordinate of the pixel
+        :param y: the Y coordinate of the pixel
+        :param connectivity: the connectivity of the fill
+        :return: the component, None if unknown
+        """
+        for component in reversed(self._components):
+            if component.connectivity == connectivity and component.contains(x, y):
+                return component
+        return None
+
+    def add(self, storage, spans, value: int, connectivity: int):
+        """
+        Remembers the region a fill just painted, unless it merged with pixels of the same color around it
+        :param storage: the pixel store the region was painted on
+        :param spans: the painted spans, as a flat array of y, x1, x2 triples
+        :param value: the color the region was painted with
+        :param connectivity: the connectivity of the fill
+        :return:
+        """
+        rows = _span_rows(spans)
+        boundary_colors = self._boundary_colors(storage, rows, connectivity)
+        if value in boundary_colors:
+            return
+        self._insert(Component(connectivity=connectivity, value=value, spans=spans, rows=rows,
+                               boundary_colors=boundary_colors))
+
+    def recolor(self, component: Component, value: int):
+        """
+        Keeps a component remembered after it was repainted with value, if it is still a whole component
+        :param component: the repainted component, no longer indexed
+        :param value: the color it was repainted with
+        :return:
+        """
+        if value in component.boundary_colors:
+            return
+        component.value = value
+        self._insert(component)
+
+    def remove(self, component: Component):
+        self._components.remove(component)
+
+    def invalidate_span(self, y: int, x1: int, x2: int):
+        """
+        Forgets the components a write of the pixels x1..x2 of row y changes, or changes the boundary of
+        :return:
+        """
+        self._components = [component for component in self._components if not component.touches(y, x1, x2)]
+
+    def invalidate_column(self, x: int, y1: int, y2: int):
+        """
+        Forgets the components a write of the pixels y1..y2 of column x changes, or changes the boundary of
+        :return:
+        """
+        self._components = [
+            component for component in self._components
+            if x < component.left - 1 or x > component.right + 1 or
+            not any(component.touches(y, x, x)
+                    for y in range(max(y1, component.top - 1), min(y2, component.bottom + 1) + 1))]
+
+    def invalidate_spans(self, spans):
+        """
+        Forgets the components a write of spans changes, or changes the boundary of
+        :param spans: flat array of y, x1, x2 triples
+        :return:
+        """
+        if not self._components or not spans:
+            return
+        rows = _span_rows(spans)
+        top, bottom = min(rows), max(rows)
+        left = min(row[0][0] for row in rows.values())
+        right = max(row[-1][1] for row in rows.values())
+        self._components = [
+            component for component in self._components
+            if bottom < component.top - 1 or top > component.bottom + 1 or
+            right < component.left - 1 or left > component.right + 1 or
+            not any(component.touches(y, x1, x2) for y, row in rows.items() for x1, x2 in row)]
+
+    def clear(self):
+        self._components = []
+
+    def _insert(self, component: Component):
+        self._components.append(component)
+        if len(self._components) > self._max_components:
+            del self._components[0]
+
+    @staticmethod
+    def _boundary_colors(storage, rows: dict, connectivity: int) -> frozenset:
+        """
+        Gets the colors of the pixels a fill of the region would reach but not paint
+        :param storage: the pixel store holding the region
+        :param rows: row -> sorted list of the (x1, x2) spans of the region in that row
+        :param connectivity: the connectivity of the fill
+        :return: the colors
+        """
+        reach = 1 if connectivity == 8 else 0
+        last_x = storage.width - 1
+        colors = set()
+        for row_y in set(rows) | {row_y - 1 for row_y in rows} | {row_y + 1 for row_y in rows}:
+            if not 0 <= row_y < storage.height:
+                continue
+            reached = []
+            for neighbour_y, neighbour_reach in ((row_y - 1, reach), (row_y, 1), (row_y + 1, reach)):
+                for x1, x2 in rows.get(neighbour_y, ()):
+                    reached.append((max(x1 - neighbour_reach, 0), min(x2 + neighbour_reach, last_x)))
+            for x1, x2 in _subtract_intervals(_merge_intervals(reached), rows.get(row_y, [])):
+                pixels = storage.get_span(row_y, x1, x2)
+                # removes one color at a time, so it costs a pass per color instead of a step per pixel
+                while pixels:
+                    colors.add(pixels[0])
+                    pixels = pixels.replace(pixels[:1], b'')
+        return frozenset(colors)
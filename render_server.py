@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import argparse
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import snapshot
+from image_editor import CompiledCommand, MatrixEditor, UnrecognizedCommandError, compile_command
+
+# commands whose work grows with the matrix, run off the event loop so they never stall the other sessions
+BLOCKING_COMMANDS = frozenset('ICLVHKFSOPGUR')
+
+# commands naming a file, only served within the server file root
+FILE_COMMANDS = frozenset('SOPG')
+
+# commands creating a matrix, whose size is checked against the session pixel limit before they run
+SIZED_COMMANDS = frozenset('IOG')
+
+# how many bytes to read from a connection at once. Every command line read at once is answered at once
+READ_CHUNK_SIZE = 1 << 16
+
+# longest command line accepted, past it the connection is closed
+MAX_LINE_LENGTH = 1 << 12
+
+
+class RenderSession(object):
+    """
+    The matrix editor of a single connection, and how its command lines are run
+    """
+    def __init__(self, executor=None, file_root: str = None, history_limit: int = None, max_pixels: int = None):
+        """
+        :param executor: where to run the BLOCKING_COMMANDS. Defaults to the event loop default executor
+        :param file_root: the directory S, O, P and G commands may save and open files in. None disables them
+        :param history_limit: if given, keep this many bytes of undo history for each matrix the session creates
+        :param max_pixels: if given, the I, O and G commands are refused matrices of more pixels
+        """
+        self.editor = None
+        # set once the session runs an X command
+        self.finished = False
+        self._executor = executor
+        self._file_root = file_root
+        self._history_limit = history_limit
+        self._max_pixels = max_pixels
+
+    async def run_line(self, line: str) -> str:
+        """
+        Runs a command line
+        :param line: the command line
+        :return: the response line: OK, or ERR and why the command failed. None for blank lines
+        """
+        split_command = line.split()
+        if not split_command:
+            return None
+        try:
+            command = compile_command(*split_command)
+            if command.name in FILE_COMMANDS:
+                command = command._replace(args=(self._file_path(command.args[0]), ))
+            if self._max_pixels is not None and command.name in SIZED_COMMANDS:
+                self._check_size(command)
+            if command.name in BLOCKING_COMMANDS:
+                editor = await asyncio.get_running_loop().run_in_executor(self._executor, command, self.editor)
+            else:
+                editor = command(self.editor)
+        except UnrecognizedCommandError:
+            return 'ERR Unrecognized command'
+        except Exception as err:
+            return 'ERR {}'.format(err)
+
+        if editor is not self.editor and isinstance(editor, MatrixEditor) and self._history_limit is not None:
+            editor.enable_history(memory_limit=self._history_limit)
+        self.editor = editor
+        self.finished = command.name == 'X'
+        return 'OK'
+
+    def _check_size(self, command: CompiledCommand):
+        """
+        Refuses a command creating a matrix of more than max_pixels pixels. Raises any necessary Exception
+        :param command: the compiled I, O or G command, its file already mapped within the file root
+        :return:
+        """
+        if command.name == 'I':
+            width, height = command.args
+        elif command.name == 'O':
+            width, height = _matrix_file_size(command.args[0], self._max_pixels)
+        else:
+            width, height = snapshot.read_snapshot_size(command.args[0])
+
+        if width * height > self._max_pixels:
+            raise ValueError('Matrix must have at most {} pixels. Received width: {} height: {}'.format(
+                self._max_pixels, width, height))
+
+    def _file_path(self, name: str) -> str:
+        """
+        Maps a file name sent by a client to a path within the file root. Raises any necessary Exception
+        :param name: the file name, relative to the file root
+        :return: the file path
+        """
+        if self._file_root is None:
+            raise ValueError('File commands are disabled')
+        root = os.path.realpath(self._file_root)
+        file_path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath((root, file_path)) != root:
+            raise ValueError('File must be within the server file root')
+        return file_path
+
+
+def _matrix_file_size(file_path: str, max_width: int) -> tuple:
+    """
+    Reads the size of a matrix saved by save_to_file from its first row and the file size, without reading the rest
+    :param file_path: the matrix file path
+    :param max_width: read no more of the first row than this many pixels. Wider rows are reported one pixel wider
+    :return: (width, height) of the matrix
+    """
+    with open(file_path, 'rb') as file:
+        first_row = file.readline(max_width + 1)
+        size = os.fstat(file.fileno()).st_size
+    if not first_row.endswith(b'\n'):
+        return len(first_row), max(size // max(len(first_row), 1), 1)
+    width = len(first_row) - 1
+    # the last row may or may not end with a new line
+    return width, (size + 1) // (width + 1)
+
+
+class RenderServer(object):
+    """
+    Serves the matrix editor command language over TCP or Unix sockets, one RenderSession per connection.
+    Clients send command lines and may send many before reading the responses: one response line per
+    non blank command line, in order. The responses to the lines read at once are written at once, and no more
+    lines are read from a connection until its client has read them
+    """
+    def __init__(self, workers: int = None, file_root: str = None, history_limit: int = None,
+                 max_pixels: int = None):
+        """
+        :param workers: how many threads run the BLOCKING_COMMANDS of all the sessions
+        :param file_root: the directory S, O, P and G commands may save and open files in. None disables them
+        :param history_limit: if given, keep this many bytes of undo history for each matrix a session creates
+        :param max_pixels: if given, the I, O and G commands of the sessions are refused matrices of more pixels
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._file_root = file_root
+        self._history_limit = history_limit
+        self._max_pixels = max_pixels
+
+    def close(self):
+        self._executor.shutdown()
+
+    async def start_tcp(self, host: str = None, port: int = 0):
+        return await asyncio.start_server(self.handle_connection, host=host, port=port)
+
+    async def start_unix(self, path: str):
+        return await asyncio.start_unix_server(self.handle_connection, path=path)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Runs the command lines of a connection until it closes or sends an X command
+        :param reader: the connection reader
+        :param writer: the connection writer
+        :return:
+        """
+        session = RenderSession(executor=self._executor, file_root=self._file_root,
+                                history_limit=self._history_limit, max_pixels=self._max_pixels)
+        unfinished_line = b''
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                *lines, unfinished_line = (unfinished_line + data).split(b'\n')
+
+                responses = []
+                for line in lines:
+                    # any byte decodes to one character, so a non ASCII color is refused as such
+                    response = await session.run_line(line.decode('latin-1'))
+                    if response is not None:
+                        responses.append(response)
+                    if session.finished:
+                        break
+                if len(unfinished_line) > MAX_LINE_LENGTH:
+                    responses.append('ERR Command line is too long')
+                    session.finished = True
+
+                if responses:
+                    writer.write(''.join(response + '\n' for response in responses).encode('latin-1'))
+                    await writer.drain()
+                if session.finished:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def serve(server: RenderServer, host: str = None, port: int = None, unix_path: str = None):
+    """
+    Serves until cancelled
+    :param server: the render server
+    :param host: the TCP host to listen on
+    :param port: the TCP port to listen on
+    :param unix_path: the Unix socket to listen on, instead of TCP
+    :return:
+    """
+    if unix_path is not None:
+        listener = await server.start_unix(unix_path)
+    else:
+        listener = await server.start_tcp(host=host, port=port)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv: list = None):
+    """
+    Main function to serve the matrix editor over the network
+    :param argv: the command line arguments. Defaults to sys.argv
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Serves the matrix editor commands, one matrix per connection')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host to listen on. Defaults to %(default)s')
+    parser.add_argument('--port', type=int, default=7070, help='TCP port to listen on. Defaults to %(default)s')
+    parser.add_argument('--unix', metavar='PATH', help='Unix socket to listen on, instead of TCP')
+    parser.add_argument('--workers', type=int, metavar='N', help='threads running the commands of all the sessions')
+    parser.add_argument('--file-root', metavar='DIR',
+                        help='directory the S, O, P and G commands save and open files in. '
+                             'Without it they are refused')
+    parser.add_argument('--history', type=int, metavar='BYTES', help='undo history size of each session')
+    parser.add_argument('--max-pixels', type=int, metavar='N',
+                        help='largest matrix, in pixels, the I, O and G commands of a session may create')
+    arguments = parser.parse_args(argv)
+
+    server = RenderServer(workers=arguments.workers, file_root=arguments.file_root, history_limit=arguments.history,
+                          max_pixels=arguments.max_pixels)
+    try:
+        asyncio.run(serve(server, host=arguments.host, port=arguments.port, unix_path=arguments.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import mmap
+import struct
+import zlib
+
+MAGIC = b'OMSN'
+VERSION = 1
+
+RAW = 'raw'
+ZLIB = 'zlib'
+_ENCODING_IDS = {RAW: 0, ZLIB: 1}
+_ENCODING_NAMES = {encoding_id: name for name, encoding_id in _ENCODING_IDS.items()}
+
+# magic, version, encoding, width, height, payload size, crc32 of the pixels. Padded to 32 bytes
+HEADER = struct.Struct('<4sBBxxIIQI4x')
+
+
+def write_snapshot(file, rows, width: int, height: int, encoding: str = RAW):
+    """
+    Writes a snapshot: a header followed by the row-major pixels, raw or zlib compressed.
+    The header is written last, once the payload size and checksum are known, so file must be seekable
+    :param file: a file opened for binary writing, at its start
+    :param rows: iterable of the height rows of the matrix
+    :param width: the matrix width
+    :param height: the matrix height
+    :param encoding: RAW or ZLIB
+    :return:
+    """
+    if encoding not in _ENCODING_IDS:
+        raise ValueError('Encoding must be one of {}. Received: {}'.format(sorted(_ENCODING_IDS), encoding))
+
+    file.write(bytes(HEADER.size))
+    checksum = 0
+    payload_size = 0
+    compressor = zlib.compressobj(6) if encoding == ZLIB else None
+    for row in rows:
+        checksum = zlib.crc32(row, checksum)
+        data = row if compressor is None else compressor.compress(row)
+        file.write(data)
+        payload_size += len(data)
+    if compressor is not None:
+        data = compressor.flush()
+        file.write(data)
+        payload_size += len(data)
+
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, VERSION, _ENCODING_IDS[encoding], width, height, payload_size, checksum))
+
+
+def read_snapshot_size(file_path: str) -> tuple:
+    """
+    Reads the size of the matrix a snapshot holds, from its header alone
+    :param file_path: the snapshot file path
+    :return: (width, height) of the matrix
+    """
+    with open(file_path, 'rb') as file:
+        header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError('Snapshot is truncated')
+    magic, _, _, width, height, _, _ = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Not a matrix snapshot')
+    return width, height
+
+
+def read_snapshot(file_path: str, copy_on_write: bool = True, verify: bool = True) -> tuple:
+    """
+    Reads a snapshot without parsing its pixels: raw ones are memory-mapped, zlib ones decompressed in one go
+    :param file_path: the snapshot file path
+    :param copy_on_write: for raw snapshots, edits stay private if True, otherwise they are written through to the file
+    :param verify: check the pixels against the header checksum, which reads all of them once
+    :return: (width, height, writable buffer of the row-major pixels)
+    """
+    with open(file_path, 'rb' if copy_on_write else 'r+b') as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('Snapshot is truncated')
+        magic, version, encoding_id, width, height, payload_size, checksum = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('Not a matrix snapshot')
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot version: {}'.format(version))
+        if encoding_id not in _ENCODING_NAMES:
+            raise ValueError('Unsupported snapshot encoding: {}'.format(encoding_id))
+        if width <= 0 or height <= 0:
+            raise ValueError('Width and Height must be positive integers. '
+                             'Received height: {} width: {}'.format(height, width))
+
+        if _ENCODING_NAMES[encoding_id] == RAW:
+            if payload_size != width * height or file.seek(0, 2) != HEADER.size + payload_size:
+                raise ValueError('Snapshot is truncated')
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY if copy_on_write else mmap.ACCESS_WRITE)
+            pixels = memoryview(mapped_file)[HEADER.size:]
+        else:
+            payload = file.read(payload_size)
+            if len(payload) != payload_size:
+                raise ValueError('Snapshot is truncated')
+            pixels = bytearray(zlib.decompress(payload))
+            if len(pixels) != width * height:
+                raise ValueError('Snapshot holds {} pixels instead of {}'.format(len(pixels), width * height))
+
+    if verify and zlib.crc32(pixels) != checksum:
+        raise ValueError('Snapshot checksum mismatch')
+    return width, height, pixels
@@ -1,5 +1,21 @@
+import asyncio
+import io
+import os
+import tempfile
 import unittest
-from image_editor import MatrixEditor
+from image_editor import (COMMANDS, MatrixEditor, command_decoder, compile_command, compile_script, run_batch,
+                          run_compiled)
+from benchmarks import compare_reports, run_benchmarks
+from command_stats import CommandStats
+from command_optimizer import OptimizedStream, optimize_commands
+from parallel_render import TiledCanvas, plan_tiles
+from pipelined_ingest import ingest_script
+from render_server import RenderServer, RenderSession
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestMatrixEditor(unittest.TestCase):
@@ -78,6 +94,11 @@ class TestMatrixEditor(unittest.TestCase):
             editor.color_dot(coordinate=dot_coordinate, color='')
         self.assertTrue('Color param must be a single character' == str(exc.exception))
 
+        for color in ('\xe9', '\u20ac'):
+            with self.assertRaises(ValueError) as exc:
+                editor.color_dot(coordinate=dot_coordinate, color=color)
+            self.assertTrue('Color param must be an ASCII character' == str(exc.exception))
+
     def test_command_v(self):
         """
         Tests the V command - Draws a vertical line
@@ -192,6 +213,46 @@ class TestMatrixEditor(unittest.TestCase):
             editor.draw_line(direction='b', a_dot_coordinate=a_dot, b_dot_coordinate=b_dot, color=color)
         self.assertTrue('Direction must be' in str(exc.exception))
 
+    def test_command_k_edges(self):
+        """
+        Tests the K command draws every pixel of the edges, whatever the corners order
+        :return:
+        """
+        height = 5
+        width = 6
+        editor = MatrixEditor(width=width, height=height)
+
+        editor.draw_rect(upper_left_corner_coordinate=(4, 3), lower_right_corner_coordinate=(1, 1), color='K')
+        self.assertEqual(editor.matrix, [list('000000'),
+                                         list('0KKKK0'),
+                                         list('0K00K0'),
+                                         list('0KKKK0'),
+                                         list('000000')])
+
+        with self.assertRaises(IndexError) as exc:
+            editor.draw_rect(upper_left_corner_coordinate=(0, 0), lower_right_corner_coordinate=(width, 2), color='K')
+        self.assertTrue('Coordinate out of bounds' == str(exc.exception))
+
+    def test_paint_segments(self):
+        """
+        Tests L, V, H and K reject their whole footprint when any corner of its bounding box is out of the matrix,
+        negative and edge overflowing coordinates included, before painting anything
+        :return:
+        """
+        editor = command_decoder(object(), 'I', '4', '3')
+        for command in (['L', '0', '1', 'A'], ['L', '5', '1', 'A'], ['V', '1', '0', '3', 'A'],
+                        ['V', '4', '1', '4', 'A'], ['H', '0', '4', '1', 'A'], ['H', '1', '5', '3', 'A'],
+                        ['K', '1', '1', '5', '3', 'A'], ['K', '2', '0', '3', '2', 'A'],
+                        ['K', '1', '-1', '2', '2', 'A']):
+            self.assertEqual(command_decoder(editor, *command), 'Coordinate out of bounds')
+        self.assertTrue(self._verify_white_matrix(editor))
+        self.assertEqual(editor.dirty_row_ranges(), [])
+
+        editor.paint_segments((('h', 0, 0, 3), ('v', 3, 0, 2)), 'A')
+        self.assertEqual(editor.matrix, [['A', 'A', 'A', 'A'], ['0', '0', '0', 'A'], ['0', '0', '0', 'A']])
+        self.assertEqual(command_decoder(editor, 'K', '1', '1', '4', '3', 'AB'),
+                         'Color param must be a single character')
+
     def test_command_f(self):
         """
         Tests the F command - Paints a region
@@ -224,6 +285,29 @@ class TestMatrixEditor(unittest.TestCase):
 
         self.assertEqual(editor.matrix, expected_matrix)
 
+    def test_command_f_connectivity(self):
+        """
+        Tests the F command with edge-only connectivity and with the region color
+        :return:
+        """
+        height = 3
+        width = 3
+        editor = MatrixEditor(width=width, height=height)
+        editor._matrix = ['010', '101', '010']
+
+        editor.color_region(dot_within_coordinate=(0, 0), color='0')
+        self.assertEqual(editor.matrix, [list('010'), list('101'), list('010')])
+
+        editor.color_region(dot_within_coordinate=(1, 1), color='.', connectivity=4)
+        self.assertEqual(editor.matrix, [list('010'), list('1.1'), list('010')])
+
+        editor.color_region(dot_within_coordinate=(0, 0), color='.')
+        self.assertEqual(editor.matrix, [list('.10'), list('1.1'), list('010')])
+
+        with self.assertRaises(ValueError) as exc:
+            editor.color_region(dot_within_coordinate=(0, 0), color='.', connectivity=6)
+        self.assertTrue('Connectivity must be' in str(exc.exception))
+
     def test_command_s(self):
         """
         Tests the S command - Saves the matrix content to a file
@@ -251,6 +335,654 @@ class TestMatrixEditor(unittest.TestCase):
                     self.assertTrue(line[:-1] == line_content)  # dont consider the \n char
         self.assertTrue(height == lines_amount)
 
+    def test_matrix_view(self):
+        """
+        Tests the compatibility view over the pixel store
+        :return:
+        """
+        height = 3
+        width = 4
+        editor = MatrixEditor(width=width, height=height)
+
+        self.assertEqual(len(editor._storage._buffer), width * height)
+
+        editor.matrix[1][2] = 'A'
+        self.assertTrue(editor.matrix[1][2] == 'A')
+        self.assertEqual(editor.matrix[1], ['0', '0', 'A', '0'])
+
+        editor._matrix = ['abcd', 'efgh', 'ijkl']
+        self.assertEqual(editor.matrix, [list('abcd'), list('efgh'), list('ijkl')])
+
+        with self.assertRaises(ValueError) as exc:
+            editor._matrix = ['abcd']
+        self.assertTrue('exactly 3 rows' in str(exc.exception))
+
+        with self.assertRaises(IndexError) as exc:
+            editor.color_dot(coordinate=(width, 0), color='A')
+        self.assertTrue('Coordinate out of bounds' == str(exc.exception))
+
+    def test_command_s_streaming(self):
+        """
+        Tests the S command streams rows through a small buffer and replaces the file atomically
+        :return:
+        """
+        editor = MatrixEditor(width=7, height=4)
+        editor.draw_rect(upper_left_corner_coordinate=(0, 0), lower_right_corner_coordinate=(6, 3), color='#')
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'image.txt')
+            with open(file_path, 'w') as file:
+                file.write('previous content')
+
+            editor.save_to_file(file_path=file_path, buffer_size=5)
+
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '#######\n#00000#\n#00000#\n#######')
+            self.assertEqual(os.listdir(directory), ['image.txt'])
+
+            editor.save_to_file(file_path=file_path, atomic=False)
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '#######\n#00000#\n#00000#\n#######')
+
+            with self.assertRaises(OSError):
+                editor.save_to_file(file_path=os.path.join(directory, 'missing', 'image.txt'))
+
+            # saved through a symbolic link, which is kept
+            link_path = os.path.join(directory, 'link.txt')
+            os.symlink(file_path, link_path)
+            editor.clear_matrix()
+            editor.save_to_file(file_path=link_path)
+            self.assertTrue(os.path.islink(link_path))
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '0000000\n0000000\n0000000\n0000000')
+
+            # new files get the permissions open() gives them, saved over ones keep theirs
+            umask = os.umask(0o027)
+            try:
+                new_path = os.path.join(directory, 'new.txt')
+                editor.save_to_file(file_path=new_path)
+                self.assertEqual(os.stat(new_path).st_mode & 0o777, 0o640)
+                os.chmod(new_path, 0o604)
+                editor.save_to_file(file_path=new_path)
+                self.assertEqual(os.stat(new_path).st_mode & 0o777, 0o604)
+            finally:
+                os.umask(umask)
+
+    def test_command_o(self):
+        """
+        Tests the O command - Opens a matrix saved by the S command
+        :return:
+        """
+        editor = MatrixEditor(width=4, height=3)
+        editor.draw_line(direction='h', a_dot_coordinate=(0, 1), b_dot_coordinate=(3, 1), color='-')
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'image.txt')
+            editor.save_to_file(file_path=file_path)
+
+            loaded_editor = MatrixEditor.load_from_file(file_path=file_path)
+            self.assertEqual((loaded_editor.width, loaded_editor.height), (4, 3))
+            self.assertEqual(loaded_editor.matrix, editor.matrix)
+
+            loaded_editor.color_region(dot_within_coordinate=(0, 0), color='a')
+            loaded_editor.draw_line(direction='v', a_dot_coordinate=(3, 0), b_dot_coordinate=(3, 2), color='|')
+            self.assertEqual(loaded_editor.matrix, [list('aaa|'), list('---|'), list('000|')])
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '0000\n----\n0000')
+
+            loaded_editor = MatrixEditor.load_from_file(file_path=file_path, copy_on_write=False)
+            loaded_editor.clear_matrix()
+            del loaded_editor
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '0000\n0000\n0000')
+
+            with open(file_path, 'w') as file:
+                file.write('0000\n000\n0000')
+            with self.assertRaises(ValueError) as exc:
+                MatrixEditor.load_from_file(file_path=file_path)
+            self.assertTrue('Every matrix row must have 4 pixels' == str(exc.exception))
+
+    def test_command_s_incremental(self):
+        """
+        Tests the S command only rewrites the rows changed since the last save
+        :return:
+        """
+        editor = MatrixEditor(width=5, height=6)
+        self.assertEqual(editor.dirty_row_ranges(), [])
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'image.txt')
+            editor.save_to_file(file_path=file_path, incremental=True)
+            inode = os.stat(file_path).st_ino
+
+            editor.color_dot(coordinate=(1, 1), color='L')
+            editor.draw_line(direction='v', a_dot_coordinate=(4, 3), b_dot_coordinate=(4, 4), color='V')
+            self.assertEqual(editor.dirty_row_ranges(), [(1, 1), (3, 4)])
+
+            editor.save_to_file(file_path=file_path, incremental=True)
+            self.assertEqual(editor.dirty_row_ranges(), [])
+            self.assertEqual(os.stat(file_path).st_ino, inode)
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), '00000\n0L000\n00000\n0000V\n0000V\n00000')
+
+            with open(file_path, 'w') as file:
+                file.write('changed elsewhere')
+            editor.color_region(dot_within_coordinate=(0, 5), color='F')
+            self.assertEqual(editor.dirty_row_ranges(), [(0, 5)])
+            editor.save_to_file(file_path=file_path, incremental=True)
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), 'FFFFF\nFLFFF\nFFFFF\nFFFFV\nFFFFV\nFFFFF')
+
+            # matrices opened from the file never see what another one saves in it
+            first_editor = command_decoder(object(), 'O', file_path)
+            second_editor = command_decoder(object(), 'O', file_path)
+            command_decoder(first_editor, 'L', '2', '2', 'Q')
+            command_decoder(first_editor, 'S', file_path)
+            self.assertEqual(second_editor.matrix[1], list('FLFFF'))
+            third_editor = command_decoder(object(), 'O', file_path)
+            command_decoder(first_editor, 'L', '3', '3', 'R')
+            command_decoder(first_editor, 'S', file_path)
+            self.assertEqual(third_editor.matrix[2], list('FFFFF'))
+            with open(file_path, 'r') as file:
+                self.assertEqual(file.read(), 'FFFFF\nFQFFF\nFFRFF\nFFFFV\nFFFFV\nFFFFF')
+
+    def test_command_p_g(self):
+        """
+        Tests snapshots load back as saved, raw and compressed, and that corrupt ones are refused
+        :return:
+        """
+        editor = command_decoder(object(), 'I', '5', '3')
+        command_decoder(editor, 'K', '2', '1', '4', '3', 'K')
+        command_decoder(editor, 'L', '5', '2', '~')
+
+        with tempfile.TemporaryDirectory() as directory:
+            raw_path = os.path.join(directory, 'matrix.raw')
+            self.assertEqual(command_decoder(editor, 'P', raw_path), True)
+            loaded_editor = command_decoder(object(), 'G', raw_path)
+            self.assertEqual(loaded_editor.matrix, editor.matrix)
+
+            # raw snapshots are mapped copy-on-write
+            loaded_editor.color_dot((0, 0), 'A')
+            self.assertEqual(MatrixEditor.load_snapshot(raw_path).matrix, editor.matrix)
+
+            zlib_path = os.path.join(directory, 'matrix.zlib')
+            editor.save_snapshot(zlib_path, encoding='zlib')
+            self.assertEqual(MatrixEditor.load_snapshot(zlib_path).matrix, editor.matrix)
+
+            with open(raw_path, 'r+b') as file:
+                file.seek(-1, os.SEEK_END)
+                file.write(b'!')
+            self.assertEqual(command_decoder(object(), 'G', raw_path), 'Snapshot checksum mismatch')
+            with open(raw_path, 'r+b') as file:
+                file.truncate(40)
+            self.assertEqual(command_decoder(object(), 'G', raw_path), 'Snapshot is truncated')
+            self.assertEqual(command_decoder(object(), 'G', zlib_path + '.missing')[:9], '[Errno 2]')
+
+    def test_fork(self):
+        """
+        Tests forks share the rows neither of them changed and never see each other edits
+        :return:
+        """
+        for backend in ('bytearray', 'rows', 'rle'):
+            editor = MatrixEditor(width=4, height=3, backend=backend)
+            editor.draw_line('h', (0, 0), (3, 0), 'A')
+            forked_editor = editor.fork()
+            fork_of_fork = forked_editor.fork()
+
+            forked_editor.color_region((0, 1), 'F')
+            editor.color_dot((0, 0), 'B')
+            self.assertEqual(editor.matrix, [['B', 'A', 'A', 'A'], ['0', '0', '0', '0'], ['0', '0', '0', '0']])
+            self.assertEqual(forked_editor.matrix, [['A', 'A', 'A', 'A'], ['F', 'F', 'F', 'F'], ['F', 'F', 'F', 'F']])
+            self.assertEqual(fork_of_fork.matrix, [['A', 'A', 'A', 'A'], ['0', '0', '0', '0'], ['0', '0', '0', '0']])
+            self.assertEqual(forked_editor.dirty_row_ranges(), [(0, 2)])
+            # the bytearray matrix moved to a row store on its first fork
+            if backend != 'rle':
+                self.assertIs(next(fork_of_fork._storage.iter_rows(2)), next(editor._storage.iter_rows(2)))
+
+    def test_region_index(self):
+        """
+        Tests filling a region the region index knows only repaints it, and edits around it forget it
+        :return:
+        """
+        editor = MatrixEditor(width=5, height=3)
+        editor.enable_history()
+        editor.enable_region_index()
+        editor.draw_line('v', (2, 0), (2, 2), 'W')
+        editor.color_region((0, 0), 'A')
+        editor.color_region((4, 0), 'B')
+        self.assertEqual(len(editor._region_index), 2)
+
+        editor.color_region((1, 1), 'C')
+        self.assertEqual(len(editor._region_index), 2)
+        self.assertEqual(editor.matrix, [list('CCWBB'), list('CCWBB'), list('CCWBB')])
+        editor.undo()
+        self.assertEqual(editor.matrix, [list('AAWBB'), list('AAWBB'), list('AAWBB')])
+        self.assertEqual(len(editor._region_index), 0)
+
+        # painted with the color around it, the region merges with it
+        editor.color_region((4, 0), 'D')
+        editor.color_region((4, 2), 'W')
+        self.assertEqual(len(editor._region_index), 0)
+        editor.color_region((0, 0), 'E')
+        editor.color_dot((2, 1), 'B')
+        self.assertEqual(len(editor._region_index), 0)
+        editor.color_region((0, 0), 'F')
+        self.assertEqual(editor.matrix, [list('FFWWW'), list('FFBWW'), list('FFWWW')])
+
+    def test_command_u_r(self):
+        """
+        Tests the U and R commands - Undo and redo the edits
+        :return:
+        """
+        editor = MatrixEditor(width=4, height=3)
+
+        with self.assertRaises(ValueError) as exc:
+            editor.undo()
+        self.assertTrue('History is disabled' == str(exc.exception))
+
+        editor.enable_history()
+        editor.draw_rect(upper_left_corner_coordinate=(0, 0), lower_right_corner_coordinate=(3, 2), color='K')
+        editor.color_region(dot_within_coordinate=(1, 1), color='F')
+        editor.clear_matrix()
+        self.assertTrue(self._verify_white_matrix(editor))
+
+        editor.undo()
+        self.assertEqual(editor.matrix, [list('KKKK'), list('KFFK'), list('KKKK')])
+        editor.undo()
+        self.assertEqual(editor.matrix, [list('KKKK'), list('K00K'), list('KKKK')])
+        editor.undo()
+        self.assertTrue(self._verify_white_matrix(editor))
+        with self.assertRaises(ValueError) as exc:
+            editor.undo()
+        self.assertTrue('Nothing to undo' == str(exc.exception))
+
+        editor.redo()
+        editor.redo()
+        self.assertEqual(editor.matrix, [list('KKKK'), list('KFFK'), list('KKKK')])
+
+        editor.color_dot(coordinate=(0, 0), color='L')
+        with self.assertRaises(ValueError) as exc:
+            editor.redo()
+        self.assertTrue('Nothing to redo' == str(exc.exception))
+
+    def test_history_memory_limit(self):
+        """
+        Tests the oldest edits are forgotten once the history is over its memory limit
+        :return:
+        """
+        editor = MatrixEditor(width=200, height=2)
+        editor.enable_history(memory_limit=300)
+
+        for color in 'abcdefghij':
+            editor.draw_line(direction='h', a_dot_coordinate=(0, 0), b_dot_coordinate=(199, 0), color=color)
+        self.assertTrue(editor._journal.memory_used <= 300)
+
+        undone = 0
+        while editor._journal.can_undo:
+            editor.undo()
+            undone += 1
+        self.assertTrue(0 < undone < 10)
+        self.assertEqual(editor.matrix[0][0], 'abcdefghij'[9 - undone])
+
+
+class TestBatch(unittest.TestCase):
+    def test_run_batch(self):
+        """
+        Tests running a command script without prompting
+        :return:
+        """
+        script = io.StringIO('I 4 3\nL 2 2 A\n\nH 1 9 1 B\nQ 1\nV 4 1 3 C\nX\nL 1 1 D\n')
+        errors = io.StringIO()
+
+        editor = run_batch(script, error_stream=errors)
+
+        self.assertEqual(editor.matrix, [list('000C'), list('0A0C'), list('000C')])
+        self.assertEqual(errors.getvalue().splitlines(), ['line 4: Coordinate out of bounds',
+                                                          'line 5: Unrecognized command'])
+
+    def test_compiled_commands(self):
+        """
+        Tests compiling commands once and replaying them
+        :return:
+        """
+        command = compile_command('k', '1', '1', '3', '2', 'R')
+        self.assertEqual(command.name, 'K')
+        self.assertEqual(command.args, (0, 0, 2, 1, 'R'))
+
+        with self.assertRaises(ValueError) as exc:
+            compile_command('L', '1', '1')
+        self.assertTrue('expects 3 arguments' in str(exc.exception))
+
+        commands = list(compile_script(['I 3 2', 'K 1 1 3 2 R', 'L 2 2 2 Q']))
+        errors = io.StringIO()
+        for _ in range(2):
+            editor = run_compiled(commands, error_stream=errors)
+            self.assertEqual(editor.matrix, [list('RRR'), list('RRR')])
+        self.assertEqual(errors.getvalue().splitlines(), ['line 3: L command expects 3 arguments. Received: 4'] * 2)
+
+        self.assertTrue(command_decoder(editor, 'L', '1', '1', 'A'))
+        self.assertIsNone(command_decoder(editor, 'Q'))
+        self.assertEqual(command_decoder(None, 'C'), 'There is no matrix to edit. Create one with the I command first')
+
+    def test_ingest_script(self):
+        """
+        Tests parsing a script in worker processes compiles it as compile_script does
+        :return:
+        """
+        script = b'I 4 3\nL 2 2 A\n\nH 1 9 1 B\nQ 1\nL 1 x A\nK 1 1 4 3 C\nF 3 2 D\nX\nL 1 1 D\n'
+        for chunk_size in (1, 7, 1 << 20):
+            commands = list(ingest_script(io.BytesIO(script), workers=2, chunk_size=chunk_size))
+            self.assertEqual([(command.name, command.args, command.line_number) for command in commands[:2]],
+                             [('I', (4, 3), 1), ('L', (1, 1, 'A'), 2)])
+            self.assertEqual([command.line_number for command in commands], [1, 2, 4, 5, 6, 7, 8, 9, 10])
+
+            errors = io.StringIO()
+            editor = run_compiled(commands, error_stream=errors)
+            self.assertEqual(editor.matrix, [list('CCCC'), list('CADC'), list('CCCC')])
+            self.assertEqual(errors.getvalue().splitlines(), [
+                'line 4: Coordinate out of bounds', 'line 5: Unrecognized command',
+                "line 6: invalid literal for int() with base 10: 'x'"])
+
+
+class TestCommandOptimizer(unittest.TestCase):
+    def test_optimize_commands(self):
+        """
+        Tests the optimizer drops painted over and unreachable commands, and merges touching segments,
+        while the script still paints the same matrix and reports the same errors
+        :return:
+        """
+        script = ['I 6 5', 'K 1 1 6 5 K', 'L 2 2 L', 'C', 'L 2 2 A', 'L 3 2 A', 'H 4 6 2 A', 'L 2 2 A',
+                  'V 1 1 9 V', 'L 6 5 B', 'L 6 5 B', 'V 6 3 4 B', 'S', 'F 1 1 F', 'X', 'L 1 1 L']
+        commands, report = optimize_commands(compile_script(script))
+
+        self.assertEqual([command.name for command in commands], ['I', 'C', 'H', 'V', 'V', None, 'F', 'X'])
+        self.assertEqual(commands[2].args, (1, 5, 1, 'A'))
+        self.assertEqual(commands[4].args, (5, 2, 4, 'B'))
+        self.assertEqual(report, (16, 1, 4, 3))
+        self.assertEqual(report.removed, 8)
+
+        expected_errors = io.StringIO()
+        expected_editor = run_batch(script, error_stream=expected_errors)
+        errors = io.StringIO()
+        editor = run_compiled(commands, error_stream=errors)
+        self.assertEqual(editor.matrix, expected_editor.matrix)
+        self.assertEqual(errors.getvalue(), expected_errors.getvalue())
+
+    def test_optimize_commands_keeps_undone_edits(self):
+        """
+        Tests an edit painted over is kept when a U command may bring it back, and dropped once an I command
+        starts a new matrix
+        :return:
+        """
+        script = ['I 3 3', 'L 1 1 A', 'L 1 1 B', 'U', 'I 3 3', 'L 1 1 A', 'L 1 1 B']
+        commands, report = optimize_commands(compile_script(script))
+
+        self.assertEqual(len(commands), 6)
+        self.assertEqual(report.overwritten, 1)
+
+    def test_optimized_stream(self):
+        """
+        Tests the optimizer streams the commands one stretch at a time, reading ahead only as far as undo may reach
+        :return:
+        """
+        script = ['I 3 2', 'L 1 1 A', 'L 1 1 B', 'F 3 2 C', 'L 2 2 A', 'U', 'L 2 2 B', 'X', 'L 1 1 A']
+        # with history the U command may reveal the first L command, so it is kept
+        for history, lines_read, names, overwritten in ((False, 4, 'ILFLULX', 1), (True, 9, 'ILLFLULX', 0)):
+            read_lines = []
+
+            def lines():
+                for line in script:
+                    read_lines.append(line)
+                    yield line
+
+            optimized_stream = OptimizedStream(compile_script(lines()), history=history)
+            commands = iter(optimized_stream)
+            self.assertEqual([next(commands).name for _ in range(2)], ['I', 'L'])
+            # only read up to the F command, or up to the X command and past it to count the unreachable ones
+            self.assertEqual(len(read_lines), lines_read)
+            self.assertEqual(''.join(['I', 'L'] + [command.name for command in commands]), names)
+            self.assertEqual(optimized_stream.report, (9, 1, overwritten, 0))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_benchmarks(self):
+        """
+        Tests every benchmark runs and reports its timing, and that reports compare within the tolerance only
+        :return:
+        """
+        report = run_benchmarks(sizes=(8, ), repeat=1)
+
+        self.assertEqual([result['name'] for result in report['results']],
+                         ['I', 'C', 'L', 'V', 'H', 'K', 'F best', 'F full', 'F worst', 'S', 'script', 'lines',
+                          'lines tiled'])
+        slower_report = dict(report, results=[dict(result, seconds=result['seconds'] * 2 + 1)
+                                              for result in report['results']])
+        self.assertFalse(any(comparison[-1] for comparison in compare_reports(report, report, tolerance=0)))
+        self.assertTrue(all(comparison[-1] for comparison in compare_reports(slower_report, report, tolerance=0.5)))
+
+
+class TestCommandStats(unittest.TestCase):
+    def test_stats(self):
+        """
+        Tests the stats count the commands and the pixels they touch, and only once enabled
+        :return:
+        """
+        stats = CommandStats()
+        errors = io.StringIO()
+        editor = run_batch(['I 5 4', 'V 3 1 4 #', 'L 9 9 A', 'F 1 2 A', 'F 4 1 A', 'L 1 1 B', 'C'],
+                           error_stream=errors, stats=stats)
+
+        self.assertEqual(stats.counts, {'I': 1, 'V': 1, 'L': 2, 'F': 2, 'C': 1})
+        self.assertEqual(stats.failures, {'L': 1})
+        self.assertEqual(stats.pixels, {'I': 0, 'V': 4, 'L': 1, 'F': 16, 'C': 20})
+        self.assertEqual(stats.fills, 2)
+        self.assertEqual(stats.fill_peak_queue, 2)
+        self.assertEqual([command['command'] for command in stats.as_dict()['commands']].count('F'), 1)
+
+        self.assertEqual(command_decoder(editor, 'K', '1', '1', '2', '2', 'K', stats=stats), True)
+        self.assertEqual(stats.counts['K'], 1)
+        self.assertEqual(stats.pixels['K'], 4)
+
+        run_batch(['I 3 3', 'L 1 1 A'])
+        self.assertEqual(stats.pixels_touched, 45)
+
+        # each pixel of a rect is counted once, corners included
+        editor = run_batch(['I 6 4', 'K 1 1 6 4 K'], stats=stats)
+        self.assertEqual(stats.pixels['K'], 4 + 16)
+        pixels_touched = stats.pixels_touched
+        editor.paint_segments(COMMANDS['K'].footprint(0, 0, 5, 3, 'P'), 'P')
+        self.assertEqual(stats.pixels_touched - pixels_touched, 16)
+
+
+class TestParallelRender(unittest.TestCase):
+    def test_plan_tiles(self):
+        """
+        Tests segments are clipped along tile boundaries, keeping their order within each tile
+        :return:
+        """
+        tiles = plan_tiles([('h', 1, 2, 9, 65), ('v', 3, 0, 5, 66), ('h', 1, 3, 3, 67)], tile_width=4, tile_height=4)
+
+        self.assertEqual(tiles, {
+            (0, 0): [('h', 1, 2, 3, 65), ('v', 3, 0, 3, 66), ('h', 1, 3, 3, 67)],
+            (1, 0): [('h', 1, 4, 7, 65)],
+            (2, 0): [('h', 1, 8, 9, 65)],
+            (0, 1): [('v', 3, 4, 5, 66)],
+        })
+
+    def test_render(self):
+        """
+        Tests a tiled canvas renders a script as the serial editor does, fills crossing tiles included
+        :return:
+        """
+        script = ['K 1 1 12 9 K', 'H 2 11 5 H', 'L 30 1 Q', 'F 3 3 F', 'V 6 1 9 V', 'L 12 9 L', 'S 1 2', 'F 1 1 .']
+        serial_errors = io.StringIO()
+        expected_editor = run_batch(['I 12 9'] + script, error_stream=serial_errors)
+
+        errors = io.StringIO()
+        with TiledCanvas(width=12, height=9, tile_width=4, tile_height=4, workers=2) as canvas:
+            editor = canvas.render(compile_script(['C'] + script), error_stream=errors)
+
+        self.assertEqual(editor.matrix, expected_editor.matrix)
+        self.assertEqual(errors.getvalue(), serial_errors.getvalue())
+        self.assertEqual(editor.dirty_row_ranges(), [(0, 8)])
+
+
+class TestRenderServer(unittest.IsolatedAsyncioTestCase):
+    async def test_sessions(self):
+        """
+        Tests pipelined commands of concurrent connections are answered in order, each on its own matrix
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            server = RenderServer(workers=2, file_root=directory)
+            listener = await server.start_unix(os.path.join(directory, 'socket'))
+
+            async def run_session(lines):
+                reader, writer = await asyncio.open_unix_connection(os.path.join(directory, 'socket'))
+                writer.write(''.join(line + '\n' for line in lines).encode())
+                await writer.drain()
+                responses = (await reader.read()).decode().splitlines()
+                writer.close()
+                await writer.wait_closed()
+                return responses
+
+            responses = await asyncio.gather(
+                run_session(['I 4 3', '', 'K 1 1 4 3 K', 'F 2 2 F', 'L 9 1 A', 'Q', 'S first', 'X', 'C']),
+                run_session(['C', 'I 2 2', 'S ../escaped', 'L 1 1 B', 'S second', 'X']),
+            )
+            listener.close()
+            await listener.wait_closed()
+            server.close()
+
+            self.assertEqual(responses[0], ['OK', 'OK', 'OK', 'ERR Coordinate out of bounds',
+                                            'ERR Unrecognized command', 'OK', 'OK'])
+            self.assertEqual(responses[1], ['ERR There is no matrix to edit. Create one with the I command first',
+                                            'OK', 'ERR File must be within the server file root', 'OK', 'OK', 'OK'])
+            with open(os.path.join(directory, 'first')) as file:
+                self.assertEqual(file.read(), 'KKKK\nKFFK\nKKKK')
+            with open(os.path.join(directory, 'second')) as file:
+                self.assertEqual(file.read(), 'B0\n00')
+
+    async def test_max_pixels(self):
+        """
+        Tests the I, O and G commands are refused matrices of more pixels than the session limit
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            session = RenderSession(file_root=directory, max_pixels=12)
+            responses = [await session.run_line(line) for line in ['I 4 4', 'I 4 3', 'S small', 'G small',
+                                                                   'I 3 3', 'P big', 'I 4 3', 'O small']]
+            MatrixEditor(width=5, height=3).save_to_file(os.path.join(directory, 'wide'))
+            MatrixEditor(width=3, height=5).save_snapshot(os.path.join(directory, 'tall'))
+            responses += [await session.run_line(line) for line in ['O wide', 'G tall', 'I 2 x', 'I +4 4', 'I 1_0 1_0']]
+
+        self.assertEqual(responses, ['ERR Matrix must have at most 12 pixels. Received width: 4 height: 4', 'OK', 'OK',
+                                     'ERR Snapshot is truncated', 'OK', 'OK', 'OK', 'OK',
+                                     'ERR Matrix must have at most 12 pixels. Received width: 5 height: 3',
+                                     'ERR Matrix must have at most 12 pixels. Received width: 3 height: 5',
+                                     "ERR invalid literal for int() with base 10: 'x'",
+                                     'ERR Matrix must have at most 12 pixels. Received width: 4 height: 4',
+                                     'ERR Matrix must have at most 12 pixels. Received width: 10 height: 10'])
+        self.assertEqual(session.editor.matrix, [['0'] * 4] * 3)
+
+
+class TestStorageBackends(unittest.TestCase):
+    def test_unknown_backend(self):
+        """
+        Tests an unknown pixel store backend is refused
+        :return:
+        """
+        with self.assertRaises(ValueError):
+            MatrixEditor(width=3, height=3, backend='paper')
+
+    def _verify_backend(self, backend: str) -> MatrixEditor:
+        """
+        Verifies a backend edits, saves and undoes as the bytearray one does
+        Made so we DRY in the tests
+        :param backend: the backend to be verified
+        :return: the matrix editor using the backend, after the edits
+        """
+        editors = [MatrixEditor(width=9, height=7), MatrixEditor(width=9, height=7, backend=backend)]
+        for editor in editors:
+            editor.enable_history()
+            editor.draw_rect((1, 1), (7, 5), 'R')
+            editor.draw_line('v', (4, 0), (4, 6), 'V')
+            editor.draw_line('h', (0, 3), (8, 3), 'H')
+            editor.color_dot((2, 2), 'D')
+            editor.color_region((0, 0), 'F', 4)
+            editor.color_region((2, 3), 'G', 8)
+        self.assertEqual(editors[1].matrix, editors[0].matrix)
+        self.assertEqual(editors[1].dirty_row_ranges(), editors[0].dirty_row_ranges())
+
+        with tempfile.TemporaryDirectory() as directory:
+            contents = []
+            for editor in editors:
+                file_path = os.path.join(directory, 'matrix')
+                editor.save_to_file(file_path)
+                with open(file_path) as file:
+                    contents.append(file.read())
+            self.assertEqual(contents[1], contents[0])
+
+        for editor in editors:
+            editor.undo()
+            editor.undo()
+        self.assertEqual(editors[1].matrix, editors[0].matrix)
+        return editors[1]
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_numpy_backend(self):
+        """
+        Tests the numpy backend edits, saves and undoes as the bytearray one does
+        :return:
+        """
+        self._verify_backend('numpy')
+
+    def test_rle_backend(self):
+        """
+        Tests the rle backend edits as the bytearray one does, keeping each row as few runs as it holds
+        :return:
+        """
+        editor = self._verify_backend('rle')
+        self.assertEqual(editor._storage.run_count, 32)
+
+        editor.clear_matrix()
+        editor.draw_rect((0, 0), (8, 6), 'K')
+        self.assertEqual(editor._storage.run_count, 2 + 5 * 3)
+
+    def test_lazy_backend(self):
+        """
+        Tests the lazy backend edits as the bytearray one does, allocating only the rows written to,
+        and clears in O(1), with or without undo history
+        :return:
+        """
+        editor = self._verify_backend('lazy')
+        matrix = editor.matrix
+        editor.clear_matrix()
+        editor.color_dot((2, 1), 'D')
+        self.assertEqual(editor.matrix[1], list('00D000000'))
+        self.assertEqual(editor.matrix[2], list('000000000'))
+        self.assertIs(next(editor._storage.iter_rows(2)), next(editor._storage.iter_rows(3)))
+
+        # the clear is undone by handing the rows back, and redone by handing them over again
+        editor.undo()
+        editor.undo()
+        self.assertEqual(editor.matrix, matrix)
+        editor.redo()
+        editor.redo()
+        self.assertEqual(editor.matrix[1], list('00D000000'))
+        self.assertEqual(editor.matrix[2], list('000000000'))
+
+        # only the rows written to are allocated, and clearing them keeps no copy of them
+        editor = MatrixEditor(width=50000, height=50000, backend='lazy')
+        editor.enable_history()
+        editor.draw_line('h', (0, 49999), (49999, 49999), 'H')
+        memory_used = editor._journal.memory_used
+        editor.clear_matrix()
+        self.assertTrue(editor._storage.get_row(49999) == b'0' * 50000)
+        self.assertLess(editor._journal.memory_used - memory_used, 60000)
+        editor.undo()
+        self.assertTrue(editor._storage.get_row(49999) == b'H' * 50000)
+
 
 if __name__ == '__main__':
     unittest.main()